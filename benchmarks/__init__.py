@@ -0,0 +1 @@
+"""Provides benchmarks that measure the export speed without Telegram."""
@@ -0,0 +1,345 @@
+"""Benchmarks the export of a chat without connecting to Telegram.
+
+Replays a synthetic or recorded chat history against a fake client and
+reports how fast it's serialized and exported. Run with
+``python -m benchmarks --help`` from the repository root.
+"""
+
+import argparse
+import asyncio
+import logging
+import resource
+import sys
+import tempfile
+import time
+import tomllib
+from dataclasses import dataclass
+from pathlib import Path
+
+from telethon import TelegramClient
+
+import ream
+from serialization.batch_size import AdaptiveBatchSize
+from serialization.context import ExportContext
+from serialization.custom_emoji import CustomEmojiResolver
+from serialization.rate_limiter import RateLimiter
+from serialization.scheduler import DownloadScheduler
+from serialization.serialization import serialize_batch
+
+from .fake_client import FakeClient
+from .history import History, record_history, synthetic_history
+
+
+@dataclass
+class Result:
+    """The measurements of a single benchmark.
+
+    Attributes
+    ----------
+    name : str
+        The name of the benchmark.
+
+    messages : int
+        How many messages were processed.
+
+    seconds : float
+        How long processing the messages took.
+
+    output_bytes : int
+        The total size of the files in the export directory afterwards.
+
+    written_bytes : int | None
+        How many bytes were written to files, or None if the platform doesn't
+        report it.
+
+    requests : int
+        How many requests were answered by the fake client.
+
+    """
+
+    name: str
+    messages: int
+    seconds: float
+    output_bytes: int
+    written_bytes: int | None
+    requests: int
+
+
+async def benchmark_serialize(
+    history: History,
+    client: FakeClient,
+    path: Path,
+    batch_size: int,
+) -> Result:
+    """Serialize all messages in batches, without writing export.json.
+
+    Parameters
+    ----------
+    history : History
+        The history to serialize.
+
+    client : FakeClient
+        The client that the messages and files are fetched from.
+
+    path : Path
+        The directory that files are downloaded to.
+
+    batch_size : int
+        How many messages are serialized at once.
+
+    Returns
+    -------
+    Result
+        The measurements of the benchmark.
+
+    """
+    messages = [
+        message async for message in client.iter_messages(history.chat.id, reverse=True)
+    ]
+    context = ExportContext(path)
+    requests = client.requests
+
+    written = __written_bytes()
+    started_at = time.monotonic()
+    for start in range(0, len(messages), batch_size):
+        await serialize_batch(messages[start : start + batch_size], context)
+    seconds = time.monotonic() - started_at
+
+    return Result(
+        "serialize",
+        len(messages),
+        seconds,
+        __directory_size(path),
+        __written_since(written),
+        client.requests - requests,
+    )
+
+
+async def benchmark_export(
+    history: History,
+    client: FakeClient,
+    path: Path,
+    batch_size: int | AdaptiveBatchSize,
+) -> Result:
+    """Export the whole chat like ream does, including export.json.
+
+    Parameters
+    ----------
+    history : History
+        The history to export.
+
+    client : FakeClient
+        The client that the chat is exported from.
+
+    path : Path
+        The directory that the export is saved to.
+
+    batch_size : int | AdaptiveBatchSize
+        How many messages are exported at once.
+
+    Returns
+    -------
+    Result
+        The measurements of the benchmark.
+
+    """
+    ream.config["export"]["path"] = str(path)
+    requests = client.requests
+
+    written = __written_bytes()
+    started_at = time.monotonic()
+    await ream.export(
+        client,
+        history.chat.id,
+        scheduler=DownloadScheduler(max_downloads=8),
+        media_store=None,
+        custom_emoji=CustomEmojiResolver(),
+        batch_size=batch_size,
+    )
+    seconds = time.monotonic() - started_at
+
+    return Result(
+        "export",
+        len(history.messages),
+        seconds,
+        __directory_size(path),
+        __written_since(written),
+        client.requests - requests,
+    )
+
+
+def __written_bytes() -> int | None:
+    # Only Linux reports how much a process has written
+    try:
+        io = Path("/proc/self/io").read_text(encoding="utf-8")
+    except OSError:
+        return None
+    for line in io.splitlines():
+        name, _, value = line.partition(":")
+        if name == "wchar":
+            return int(value)
+    return None
+
+
+def __written_since(written: int | None) -> int | None:
+    now = __written_bytes()
+    return now - written if now is not None and written is not None else None
+
+
+def __directory_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def __peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def __report(result: Result) -> None:
+    mb = 1024 * 1024
+    amplification = (
+        f"{result.written_bytes / result.output_bytes:.2f}x"
+        if result.written_bytes is not None and result.output_bytes
+        else "n/a"
+    )
+    print(  # noqa: T201
+        f"{result.name:<10}"
+        f" {result.messages:>8} messages"
+        f" {result.seconds:>8.2f} s"
+        f" {result.messages / result.seconds:>9.1f} messages/s"
+        f" {result.output_bytes / mb / result.seconds:>8.2f} MB/s"
+        f" {result.requests:>7} requests"
+        f"   peak RSS {__peak_rss() / mb:.0f} MB"
+        f"   write amplification {amplification}",
+    )
+
+
+async def __record(client: TelegramClient, arguments: argparse.Namespace) -> None:
+    history = await record_history(client, arguments.record, arguments.messages)
+    history.save(arguments.history)
+    print(f"Recorded {len(history.messages)} messages to {arguments.history}")  # noqa: T201
+
+
+async def __main(arguments: argparse.Namespace) -> None:
+    history = (
+        History.load(arguments.history)
+        if arguments.history
+        else synthetic_history(arguments.messages, arguments.seed)
+    )
+
+    ream.config = {
+        "export": {
+            "parallel_fetches": arguments.parallel_fetches,
+            "pipeline_depth": arguments.pipeline_depth,
+            "media_queue": arguments.media_queue,
+        },
+    }
+
+    for name in arguments.benchmarks or ["serialize", "export"]:
+        rate_limiter = RateLimiter()
+        client = FakeClient(
+            history,
+            rate_limiter=rate_limiter,
+            latency=arguments.latency,
+            bytes_per_second=arguments.bytes_per_second,
+            flood_wait_rate=arguments.flood_wait_rate,
+        )
+        batch_size = (
+            AdaptiveBatchSize(rate_limiter)
+            if arguments.batch_size == "auto"
+            else int(arguments.batch_size)
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            if name == "serialize":
+                result = await benchmark_serialize(
+                    history,
+                    client,
+                    Path(directory),
+                    batch_size if isinstance(batch_size, int) else batch_size.size,
+                )
+            else:
+                result = await benchmark_export(
+                    history,
+                    client,
+                    Path(directory),
+                    batch_size,
+                )
+        __report(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the export of a chat against a fake client.",
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="{serialize,export}",
+        help="the benchmarks to run, all of them by default",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=5000,
+        help="how many messages to generate or record",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the messages")
+    parser.add_argument(
+        "--history",
+        type=Path,
+        help="replay a recorded history from this file instead of generating one",
+    )
+    parser.add_argument(
+        "--record",
+        type=int,
+        metavar="CHAT",
+        help="record the history of a real chat to --history using ream.toml",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds that every request takes",
+    )
+    parser.add_argument(
+        "--bytes-per-second",
+        type=int,
+        default=20 * 1024 * 1024,
+        help="download speed of files",
+    )
+    parser.add_argument(
+        "--flood-wait-rate",
+        type=float,
+        default=0,
+        help="share of requests that run into a one second flood wait",
+    )
+    parser.add_argument("--batch-size", default="100", help='a number or "auto"')
+    parser.add_argument("--parallel-fetches", type=int, default=1)
+    parser.add_argument("--pipeline-depth", type=int, default=2)
+    parser.add_argument("--media-queue", action="store_true")
+    arguments = parser.parse_args()
+
+    if arguments.record and not arguments.history:
+        parser.error("--record requires --history")
+    if unknown := set(arguments.benchmarks) - {"serialize", "export"}:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if arguments.record:
+        with Path("ream.toml").open("rb") as f:
+            config = tomllib.load(f)
+
+        client = TelegramClient(
+            "ream",
+            config["api"]["app_id"],
+            config["api"]["app_hash"],
+            app_version="1.0.0",
+        )
+        with client:
+            client.loop.run_until_complete(__record(client, arguments))
+    else:
+        asyncio.run(__main(arguments))
@@ -0,0 +1,498 @@
+"""Checks that every export path produces the same files as the original one.
+
+The reference is exported by the serializer of an earlier revision, by
+default the last one before the export was optimized. It's loaded from git
+and driven the way the exporter of that revision drove it: the messages are serialized in batches
+of 100, and the whole chat is dumped with ``json.dumps`` after every batch.
+The same chat history is then exported by the current code with the default
+settings and with each optimized path enabled.
+
+The resulting export.json files are compared byte by byte, along with the
+names and sizes of the downloaded files. The time of every export is
+reported next to the reference, so that a speedup can be shown to not change
+the output. Run with ``python -m benchmarks.equivalence --help`` from the
+repository root.
+"""
+
+import argparse
+import asyncio
+import difflib
+import importlib
+import inspect
+import io
+import json
+import logging
+import re
+import subprocess  # noqa: S404
+import sys
+import tarfile
+import tempfile
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+from telethon.tl.custom.message import Message
+
+import ream
+from serialization.batch_size import AdaptiveBatchSize
+from serialization.context import ExportContext
+from serialization.custom_emoji import CustomEmojiResolver
+from serialization.rate_limiter import RateLimiter
+from serialization.scheduler import DownloadScheduler
+from storage.media_store import MediaStore
+
+from .fake_client import FakeClient
+from .history import History, synthetic_history
+
+
+@dataclass
+class Variant:
+    """The settings of a single export path.
+
+    Attributes
+    ----------
+    name : str
+        The name of the variant in the report.
+
+    batch_size : int | str
+        The "batch_size" setting, either a number or "auto".
+
+    parallel_fetches : int
+        The "parallel_fetches" setting.
+
+    pipeline_depth : int
+        The "pipeline_depth" setting.
+
+    media_queue : bool
+        The "media_queue" setting.
+
+    download_part_size : int
+        The "download_part_size" setting.
+
+    download_connections : int
+        The "download_connections" setting.
+
+    media_store : bool
+        If True, files are downloaded through a media store that is kept
+        next to the export.
+
+    custom_emoji_cache : bool
+        If True, the mime types of custom emoji are cached in a file next to
+        the export, which is used by every run of the variant.
+
+    resumed : bool
+        If True, the first half of the history is exported in a separate
+        run before the rest, like an incremental export.
+
+    """
+
+    name: str
+    batch_size: int | str = 100
+    parallel_fetches: int = 1
+    pipeline_depth: int = 2
+    media_queue: bool = False
+    download_part_size: int = ExportContext.download_part_size
+    download_connections: int = 1
+    media_store: bool = False
+    custom_emoji_cache: bool = False
+    resumed: bool = False
+
+
+VARIANTS = [
+    Variant("default"),
+    Variant("small_batches", batch_size=7),
+    Variant("adaptive_batches", batch_size="auto"),
+    Variant("parallel_fetches", parallel_fetches=4),
+    Variant("deep_pipeline", pipeline_depth=8),
+    Variant("media_queue", media_queue=True),
+    # The synthetic documents are smaller than the default part size
+    Variant(
+        "multipart_downloads",
+        download_part_size=512 * 1024,
+        download_connections=4,
+    ),
+    Variant("media_store", media_store=True),
+    Variant("resumed", resumed=True),
+    Variant("resumed_with_emoji_cache", resumed=True, custom_emoji_cache=True),
+]
+
+# The last revision before the export was optimized, whose output every
+# variant has to match
+REFERENCE_REVISION = "7c6a62f7afd8d3c4a629557cecce5947d31eb785"
+
+
+async def export_variant(
+    history: History,
+    path: Path,
+    variant: Variant,
+    latency: float = 0,
+) -> float:
+    """Export a history to a directory with the settings of a variant.
+
+    Parameters
+    ----------
+    history : History
+        The history to export.
+
+    path : Path
+        The directory that the export is saved to.
+
+    variant : Variant
+        The settings of the export.
+
+    latency : float
+        How many seconds every request of the fake client takes.
+
+    Returns
+    -------
+    float
+        How many seconds the export took.
+
+    """
+    ream.config = {
+        "export": {
+            "path": str(path),
+            "parallel_fetches": variant.parallel_fetches,
+            "pipeline_depth": variant.pipeline_depth,
+            "media_queue": variant.media_queue,
+            "download_part_size": variant.download_part_size,
+            "download_connections": variant.download_connections,
+        },
+    }
+
+    # The store and the cache are kept next to the export, so that they
+    # aren't compared with the reference.
+    media_store = (
+        MediaStore(path.with_name(f"{path.name}.media"))
+        if variant.media_store
+        else None
+    )
+    custom_emoji_cache = (
+        path.with_name(f"{path.name}.custom_emoji.json")
+        if variant.custom_emoji_cache
+        else None
+    )
+
+    runs = [history]
+    if variant.resumed:
+        half = History(history.messages[: len(history.messages) // 2], history.users)
+        runs.insert(0, half)
+
+    started_at = time.monotonic()
+    for run in runs:
+        rate_limiter = RateLimiter()
+        await ream.export(
+            FakeClient(run, rate_limiter=rate_limiter, latency=latency),
+            history.chat.id,
+            scheduler=DownloadScheduler(max_downloads=8),
+            media_store=media_store,
+            custom_emoji=CustomEmojiResolver(custom_emoji_cache),
+            batch_size=AdaptiveBatchSize(rate_limiter)
+            if variant.batch_size == "auto"
+            else int(variant.batch_size),
+        )
+    return time.monotonic() - started_at
+
+
+def load_serializer(revision: str, directory: Path) -> ModuleType:
+    """Import the serialization module of another revision.
+
+    The serialization package of the revision is extracted from git and
+    imported under another name, next to the current one. Only revisions
+    whose package doesn't depend on other modules of the same revision are
+    supported, since those would be imported from the current tree instead.
+
+    Parameters
+    ----------
+    revision : str
+        The git revision.
+
+    directory : Path
+        An empty directory that the package is extracted to. It has to exist
+        for as long as the module is used.
+
+    Returns
+    -------
+    ModuleType
+        The "serialization.serialization" module of the revision.
+
+    Raises
+    ------
+    ValueError
+        If the package of the revision imports other modules of ream.
+
+    """
+    archive = subprocess.run(  # noqa: S603
+        ["git", "archive", revision, "serialization"],  # noqa: S607
+        check=True,
+        capture_output=True,
+    ).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory, filter="data")
+
+    for module in (directory / "serialization").glob("*.py"):
+        if __OUTSIDE_IMPORT.search(module.read_text(encoding="utf-8")):
+            msg = (
+                f"The serializer of {revision} imports other modules of ream, "
+                "so it can't be used as the reference"
+            )
+            raise ValueError(msg)
+    (directory / "serialization").rename(directory / __REFERENCE_PACKAGE)
+
+    sys.path.insert(0, str(directory))
+    return importlib.import_module(f"{__REFERENCE_PACKAGE}.serialization")
+
+
+async def export_reference(
+    history: History,
+    path: Path,
+    serialization: ModuleType,
+    latency: float = 0,
+) -> float:
+    """Export a history to a directory the way the reference revision did.
+
+    Parameters
+    ----------
+    history : History
+        The history to export.
+
+    path : Path
+        The directory that the export is saved to.
+
+    serialization : ModuleType
+        The serialization module of the reference revision, as returned by
+        "load_serializer".
+
+    latency : float
+        How many seconds every request of the fake client takes.
+
+    Returns
+    -------
+    float
+        How many seconds the export took.
+
+    """
+    chat = history.chat
+    path /= str(chat.id)
+    path.mkdir(parents=True)
+
+    # Early revisions serialize into a directory, later ones into the
+    # context of the export.
+    serialize = serialization.serialize
+    destination: object = path
+    if "path" not in inspect.signature(serialize).parameters:
+        context = importlib.import_module(f"{__REFERENCE_PACKAGE}.context")
+        destination = context.ExportContext(path)
+
+    client = FakeClient(history, rate_limiter=RateLimiter(), latency=latency)
+    chat_data: dict[str, Any] = {
+        "name": chat.first_name,
+        "type": "personal_chat",
+        "id": chat.id,
+        "messages": [],
+    }
+
+    started_at = time.monotonic()
+    async for batch in __batches(client.iter_messages(chat.id, reverse=True)):
+        chat_data["messages"] += await asyncio.gather(
+            *[serialize(message, destination) for message in batch],
+        )
+        (path / "export.json").write_text(
+            json.dumps(chat_data, indent=1, ensure_ascii=False),
+            encoding="utf-8",
+        )
+    return time.monotonic() - started_at
+
+
+def compare_exports(reference: Path, export: Path) -> list[str]:
+    """Compare two export directories.
+
+    Parameters
+    ----------
+    reference : Path
+        The export directory that is assumed to be correct.
+
+    export : Path
+        The export directory that is compared to it.
+
+    Returns
+    -------
+    list[str]
+        The differences between the exports, empty if they're identical.
+
+    """
+    differences = []
+
+    expected = __export_json(reference)
+    actual = __export_json(export)
+    if expected != actual:
+        offset = next(
+            (
+                i
+                for i, (a, b) in enumerate(zip(expected, actual, strict=False))
+                if a != b
+            ),
+            min(len(expected), len(actual)),
+        )
+        differences.append(f"export.json differs from byte {offset}")
+        differences += list(
+            difflib.unified_diff(
+                expected.decode(errors="replace").splitlines(),
+                actual.decode(errors="replace").splitlines(),
+                "reference",
+                "export",
+                lineterm="",
+            ),
+        )[:__MAX_DIFF_LINES]
+
+    expected_files = __files(reference)
+    actual_files = __files(export)
+    differences += [
+        f"missing {file}" for file in sorted(expected_files.keys() - actual_files)
+    ]
+    differences += [
+        f"unexpected {file}" for file in sorted(actual_files.keys() - expected_files)
+    ]
+    differences += [
+        f"{file} has {actual_files[file]} bytes instead of {size}"
+        for file, size in sorted(expected_files.items())
+        if file in actual_files and actual_files[file] != size
+    ]
+
+    return differences
+
+
+# How many lines of the export.json diff are shown
+__MAX_DIFF_LINES = 40
+
+# The name that the serialization package of the reference is imported as
+__REFERENCE_PACKAGE = "reference_serialization"
+
+# The batch size of the reference revision
+__REFERENCE_BATCH_SIZE = 100
+
+# Imports of the modules of ream outside of the serialization package
+__OUTSIDE_IMPORT = re.compile(r"^\s*(?:from|import) (?:storage|ream)\b", re.MULTILINE)
+
+
+async def __batches(messages: AsyncIterator[Message]) -> AsyncIterator[list[Message]]:
+    batch = []
+    async for message in messages:
+        batch.append(message)
+        if len(batch) >= __REFERENCE_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def __export_json(path: Path) -> bytes:
+    files = list(path.glob("*/export.json"))
+    return files[0].read_bytes() if files else b""
+
+
+def __files(path: Path) -> dict[str, int]:
+    # Hidden files hold the state of an export, not its content
+    return {
+        file.relative_to(path).as_posix(): file.stat().st_size
+        for file in path.rglob("*")
+        if file.is_file()
+        and file.name not in {"export.json", "messages.jsonl"}
+        and not file.name.startswith(".")
+        and file.suffix != ".part"
+    }
+
+
+def __report(name: str, seconds: float, reference: float, result: str) -> None:
+    print(  # noqa: T201
+        f"{name:<24} {seconds:>8.2f} s {reference / seconds:>6.2f}x   {result}",
+    )
+
+
+async def __main(arguments: argparse.Namespace) -> int:
+    history = (
+        History.load(arguments.history)
+        if arguments.history
+        else synthetic_history(arguments.messages, arguments.seed)
+    )
+    revision = arguments.against
+
+    differs = False
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            serialization = await asyncio.to_thread(
+                load_serializer,
+                revision,
+                Path(directory) / "code",
+            )
+        except ValueError as error:
+            print(error, file=sys.stderr)  # noqa: T201
+            return 2
+        reference_path = Path(directory) / "reference"
+        reference = await export_reference(
+            history,
+            reference_path,
+            serialization,
+            arguments.latency,
+        )
+        __report(revision[:12], reference, reference, "reference")
+
+        for variant in VARIANTS:
+            path = Path(directory) / variant.name
+            seconds = await export_variant(history, path, variant, arguments.latency)
+            differences = compare_exports(reference_path, path)
+            __report(
+                variant.name,
+                seconds,
+                reference,
+                "differs" if differences else "identical",
+            )
+            for line in differences:
+                print(f"    {line}")  # noqa: T201
+            differs = differs or bool(differences)
+
+    return 1 if differs else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.equivalence",
+        description=(
+            "Check that every export path produces the same export as the "
+            "original exporter, and compare their speed."
+        ),
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=2000,
+        help="how many messages to generate",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the messages")
+    parser.add_argument(
+        "--history",
+        type=Path,
+        help="replay a recorded history from this file instead of generating one",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.01,
+        help="seconds that every request takes",
+    )
+    parser.add_argument(
+        "--against",
+        metavar="REV",
+        default=REFERENCE_REVISION,
+        help=(
+            "export the reference with the serializer of this git revision "
+            "instead of the last one before the export was optimized"
+        ),
+    )
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(__main(arguments)))
@@ -0,0 +1,254 @@
+"""Provides the "FakeClient" class that replays a chat history locally."""
+
+import asyncio
+import random
+
+from telethon.errors import FloodWaitError
+from telethon.network.mtprotosender import MTProtoSender
+from telethon.sessions.memory import MemorySession
+from telethon.tl import functions
+from telethon.tl.tlobject import TLRequest
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeCustomEmoji,
+    InputDocumentFileLocation,
+    InputMessageID,
+    InputPhotoFileLocation,
+    InputStickerSetEmpty,
+    InputUserSelf,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageService,
+    Photo,
+    PhotoSize,
+    User,
+)
+from telethon.tl.types import (
+    Message as RawMessage,
+)
+from telethon.tl.types.messages import Messages, MessagesSlice
+from telethon.tl.types.storage import FileUnknown
+from telethon.tl.types.upload import File
+
+from serialization.rate_limiter import RateLimitedClient, RateLimiter
+
+from .history import History
+
+
+class FakeClient(RateLimitedClient):
+    """A client that answers requests from a recorded history.
+
+    Requests are answered at the lowest level of Telethon, so iterating over
+    messages and downloading files go through the same code as with a real
+    client, including the rate limiter. Every request takes some time, and
+    files are filled with zeros at a limited speed.
+
+    Parameters
+    ----------
+    history : History
+        The history of the chat that is replayed.
+
+    rate_limiter : RateLimiter
+        The rate limiter that the requests are sent through.
+
+    latency : float
+        How many seconds every request takes.
+
+    bytes_per_second : int | None
+        The download speed of files. Unlimited if None.
+
+    flood_wait_rate : float
+        The share of requests that run into a flood wait.
+
+    flood_wait_seconds : int
+        How long each flood wait is.
+
+    Attributes
+    ----------
+    requests : int
+        How many requests were answered, including flood waits.
+
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        history: History,
+        *,
+        rate_limiter: RateLimiter,
+        latency: float = 0.05,
+        bytes_per_second: int | None = None,
+        flood_wait_rate: float = 0,
+        flood_wait_seconds: int = 1,
+    ) -> None:
+        session = MemorySession()  # type: ignore[no-untyped-call]
+        # Telethon refuses empty credentials, even though they're never sent
+        super().__init__(
+            session,
+            1,
+            "benchmark",
+            app_version="benchmark",
+            rate_limiter=rate_limiter,
+        )
+
+        self.history = history
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.flood_wait_rate = flood_wait_rate
+        self.flood_wait_seconds = flood_wait_seconds
+
+        self.requests = 0
+
+        self._random = random.Random(0)
+        self._newest_first = sorted(
+            history.messages,
+            key=lambda message: message.id,
+            reverse=True,
+        )
+        self._file_sizes = self._index_file_sizes(history)
+
+        # Make the users known to the session, like after a real request
+        session.process_entities(  # type: ignore[no-untyped-call]
+            Messages(messages=[], chats=[], users=[*history.users]),
+        )
+
+    async def _call(
+        self,
+        sender: MTProtoSender,  # noqa: ARG002
+        request: TLRequest,
+        ordered: bool = False,  # noqa: ARG002, FBT001, FBT002
+        flood_sleep_threshold: int | None = None,  # noqa: ARG002
+    ) -> object:
+        return await self.rate_limiter.run(lambda: self._answer(request))
+
+    async def _borrow_exported_sender(self, dc_id: int) -> MTProtoSender:  # noqa: ARG002
+        # Files are answered by _call too, so every data center is the same
+        return self._sender
+
+    async def _return_exported_sender(self, sender: MTProtoSender) -> None:
+        pass
+
+    async def _answer(self, request: TLRequest) -> object:
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+
+        if self._random.random() < self.flood_wait_rate:
+            raise FloodWaitError(request, capture=self.flood_wait_seconds)  # type: ignore[no-untyped-call]
+
+        match request:
+            case functions.messages.GetHistoryRequest():
+                return self._history(request)
+            case functions.messages.GetMessagesRequest():
+                # Telethon only converts plain ids when sending the request
+                ids = {
+                    message if isinstance(message, int) else message.id
+                    for message in request.id
+                    if isinstance(message, int | InputMessageID)
+                }
+                return self._messages(
+                    [message for message in self._newest_first if message.id in ids],
+                )
+            case functions.users.GetUsersRequest():
+                return [self._user(user) for user in request.id]
+            case functions.messages.GetCustomEmojiDocumentsRequest():
+                return [
+                    self._custom_emoji(document_id)
+                    for document_id in request.document_id
+                ]
+            case functions.upload.GetFileRequest():
+                return await self._file(request)
+
+        msg = f"The fake client can't answer {type(request).__name__}"
+        raise NotImplementedError(msg)
+
+    def _history(
+        self,
+        request: functions.messages.GetHistoryRequest,
+    ) -> MessagesSlice:
+        messages = [
+            message
+            for message in self._newest_first
+            if (not request.max_id or message.id < request.max_id)
+            and message.id > request.min_id
+        ]
+
+        # Telegram returns the messages older than the offset, shifted by the
+        # added offset, which is negative when iterating in reverse
+        start = next(
+            (
+                i
+                for i, message in enumerate(messages)
+                if not request.offset_id or message.id < request.offset_id
+            ),
+            len(messages),
+        )
+        start += request.add_offset
+        end = start + request.limit
+
+        # Telethon only asks for more messages if it gets a slice of them
+        return MessagesSlice(
+            count=len(messages),
+            messages=[*messages[max(start, 0) : max(end, 0)]],
+            chats=[],
+            users=[*self.history.users],
+        )
+
+    def _messages(self, messages: list[RawMessage | MessageService]) -> Messages:
+        return Messages(messages=[*messages], chats=[], users=[*self.history.users])
+
+    def _user(self, input_user: object) -> User:
+        if isinstance(input_user, InputUserSelf):
+            return self.history.me
+        user_id = getattr(input_user, "user_id", None)
+        return next(user for user in self.history.users if user.id == user_id)
+
+    def _custom_emoji(self, document_id: int) -> Document:
+        self._file_sizes[document_id, ""] = 16 * 1024
+        return Document(
+            id=document_id,
+            access_hash=0,
+            file_reference=b"",
+            date=None,
+            mime_type="application/x-tgsticker",
+            size=16 * 1024,
+            dc_id=2,
+            attributes=[
+                DocumentAttributeCustomEmoji(
+                    alt="⭐",
+                    stickerset=InputStickerSetEmpty(),
+                ),
+            ],
+        )
+
+    async def _file(self, request: functions.upload.GetFileRequest) -> File:
+        location = request.location
+        if not isinstance(location, InputPhotoFileLocation | InputDocumentFileLocation):
+            msg = f"The fake client can't download {type(location).__name__}"
+            raise NotImplementedError(msg)
+
+        size = self._file_sizes.get((location.id, location.thumb_size), 0)
+        length = max(0, min(request.limit, size - request.offset))
+        if self.bytes_per_second:
+            await asyncio.sleep(length / self.bytes_per_second)
+
+        return File(type=FileUnknown(), mtime=0, bytes=bytes(length))
+
+    @staticmethod
+    def _index_file_sizes(history: History) -> dict[tuple[int, str], int]:
+        sizes: dict[tuple[int, str], int] = {}
+        for message in history.messages:
+            media = getattr(message, "media", None)
+            photo = media.photo if isinstance(media, MessageMediaPhoto) else None
+            document = (
+                media.document if isinstance(media, MessageMediaDocument) else None
+            )
+
+            if isinstance(photo, Photo):
+                for size in photo.sizes:
+                    if isinstance(size, PhotoSize):
+                        sizes[photo.id, size.type] = size.size
+            if isinstance(document, Document):
+                sizes[document.id, ""] = document.size
+                for thumb in document.thumbs or []:
+                    if isinstance(thumb, PhotoSize):
+                        sizes[document.id, thumb.type] = thumb.size
+        return sizes
@@ -0,0 +1,318 @@
+"""Provides the chat histories that benchmarks replay."""
+
+import random
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+from telethon import TelegramClient
+from telethon.extensions.binaryreader import BinaryReader
+from telethon.helpers import add_surrogate
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeFilename,
+    MessageActionPhoneCall,
+    MessageEntityBold,
+    MessageEntityCustomEmoji,
+    MessageEntityTextUrl,
+    MessageFwdHeader,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageReplyHeader,
+    MessageService,
+    PeerUser,
+    PhoneCallDiscardReasonHangup,
+    Photo,
+    PhotoSize,
+    TypeMessageEntity,
+    User,
+)
+from telethon.tl.types import (
+    Message as RawMessage,
+)
+from telethon.tl.types.messages import Messages
+
+
+@dataclass
+class History:
+    """A chat history that can be replayed by a fake client.
+
+    Attributes
+    ----------
+    messages : list[RawMessage | MessageService]
+        The messages of the chat, from oldest to newest.
+
+    users : list[User]
+        The users that appear in the messages, including the current user,
+        who is marked with "is_self", and the other user of the chat.
+
+    """
+
+    messages: list[RawMessage | MessageService]
+    users: list[User]
+
+    @property
+    def chat(self) -> User:
+        """The other user of the chat."""
+        me = self.me
+        return next(user for user in self.users if user.id != me.id)
+
+    @property
+    def me(self) -> User:
+        """The user that the history was recorded by."""
+        return next(user for user in self.users if user.is_self)
+
+    def save(self, path: Path) -> None:
+        """Save the history in the binary format of Telegram.
+
+        Parameters
+        ----------
+        path : Path
+            The file to save the history to.
+
+        """
+        messages = Messages(messages=[*self.messages], chats=[], users=[*self.users])
+        path.write_bytes(bytes(messages))
+
+    @classmethod
+    def load(cls, path: Path) -> "History":
+        """Load a history that was saved before.
+
+        Parameters
+        ----------
+        path : Path
+            The file that the history was saved to.
+
+        Returns
+        -------
+        History
+            The loaded history.
+
+        """
+        with BinaryReader(path.read_bytes()) as reader:  # type: ignore[no-untyped-call]
+            messages = reader.tgread_object()
+        return cls(messages.messages, messages.users)
+
+
+async def record_history(client: TelegramClient, chat: int, limit: int) -> History:
+    """Record the newest messages of a real chat.
+
+    Parameters
+    ----------
+    client : TelegramClient
+        A client that is logged in to Telegram.
+
+    chat : int
+        The id of the chat to record.
+
+    limit : int
+        How many of the newest messages are recorded.
+
+    Returns
+    -------
+    History
+        The recorded history.
+
+    """
+    messages: list[RawMessage | MessageService] = []
+    entities = [await client.get_me(), await client.get_entity(chat)]
+
+    async for message in client.iter_messages(chat, limit=limit):
+        if isinstance(message, RawMessage | MessageService):
+            messages.append(message)
+        entities += [message.sender, message.via_bot, *(message.action_entities or [])]
+        if message.forward:
+            entities.append(message.forward.sender)
+
+    users = {entity.id: entity for entity in entities if isinstance(entity, User)}
+
+    messages.reverse()
+    return History(messages, list(users.values()))
+
+
+def synthetic_history(count: int, seed: int = 0) -> History:
+    """Generate a personal chat with a realistic mix of messages.
+
+    Most messages are text, partly with formatting and custom emoji. Some
+    are replies or forwards, some have photos or files, and a few are calls.
+
+    Parameters
+    ----------
+    count : int
+        How many messages are generated.
+
+    seed : int
+        The seed of the generator, so that the same history can be
+        generated again.
+
+    Returns
+    -------
+    History
+        The generated history.
+
+    """
+    rng = random.Random(seed)
+
+    me = User(id=1000, is_self=True, access_hash=1, first_name="Ream")
+    partner = User(
+        id=2000,
+        access_hash=2,
+        first_name="Benchmark",
+        last_name="Partner",
+        username="partner",
+    )
+    forwarded = User(id=3000, access_hash=3, first_name="Forwarded")
+
+    peer = PeerUser(partner.id)
+    date = datetime(2024, 1, 1, tzinfo=UTC)
+    messages: list[RawMessage | MessageService] = []
+
+    for message_id in range(1, count + 1):
+        date += timedelta(seconds=rng.randint(1, 3600))
+        sender = rng.choice([me, partner])
+        kind = rng.choices(list(__MESSAGE_KINDS), list(__MESSAGE_KINDS.values()))[0]
+
+        if kind == "call":
+            messages.append(
+                MessageService(
+                    id=message_id,
+                    peer_id=peer,
+                    date=date,
+                    action=MessageActionPhoneCall(
+                        call_id=message_id,
+                        reason=PhoneCallDiscardReasonHangup(),
+                        duration=rng.randint(1, 3600),
+                    ),
+                    out=sender is me,
+                    from_id=PeerUser(sender.id),
+                ),
+            )
+            continue
+
+        text, entities = __synthetic_text(rng)
+        media: MessageMediaPhoto | MessageMediaDocument | None = None
+        if kind == "photo":
+            media = MessageMediaPhoto(photo=__synthetic_photo(rng, message_id, date))
+        elif kind == "document":
+            media = MessageMediaDocument(
+                document=__synthetic_document(rng, message_id, date),
+            )
+
+        messages.append(
+            RawMessage(
+                id=message_id,
+                peer_id=peer,
+                date=date,
+                message=text,
+                out=sender is me,
+                from_id=PeerUser(sender.id),
+                fwd_from=MessageFwdHeader(date=date, from_id=PeerUser(forwarded.id))
+                if rng.random() < __FORWARD_SHARE
+                else None,
+                reply_to=MessageReplyHeader(
+                    reply_to_msg_id=rng.randint(1, message_id - 1),
+                )
+                if message_id > 1 and rng.random() < __REPLY_SHARE
+                else None,
+                media=media,
+                entities=entities or None,
+            ),
+        )
+
+    return History(messages, [me, partner, forwarded])
+
+
+# How often each kind of message appears, relative to the others
+__MESSAGE_KINDS = {"text": 80, "photo": 13, "document": 5, "call": 2}
+__FORWARD_SHARE = 0.05
+__REPLY_SHARE = 0.1
+
+# How often each kind of formatting is applied to a word
+__CUSTOM_EMOJI_SHARE = 0.03
+__BOLD_SHARE = 0.05
+__LINK_SHARE = 0.02
+
+# Custom emoji are documents too, so their ids are kept apart from the ones of
+# the documents that messages are sent with
+__CUSTOM_EMOJI_ID_BASE = 1_000_000_000
+
+__WORDS = [
+    "hello",
+    "export",
+    "message",
+    "telegram",
+    "benchmark",
+    "привет",
+    "ok",
+    "🙂",
+    "see",
+    "you",
+    "tomorrow",
+]
+
+
+def __synthetic_text(rng: random.Random) -> tuple[str, list[TypeMessageEntity]]:
+    text = ""
+    entities: list[TypeMessageEntity] = []
+
+    for i in range(rng.randint(1, 30)):
+        if i:
+            text += " "
+        offset = len(add_surrogate(text))
+        kind = rng.random()
+
+        if kind < __CUSTOM_EMOJI_SHARE:
+            text += "⭐"
+            entities.append(
+                MessageEntityCustomEmoji(
+                    offset=offset,
+                    length=1,
+                    document_id=__CUSTOM_EMOJI_ID_BASE + rng.randint(1, 20),
+                ),
+            )
+            continue
+
+        word = rng.choice(__WORDS)
+        text += word
+        length = len(add_surrogate(word))
+        kind -= __CUSTOM_EMOJI_SHARE
+        if kind < __BOLD_SHARE:
+            entities.append(MessageEntityBold(offset=offset, length=length))
+        elif kind < __BOLD_SHARE + __LINK_SHARE:
+            entities.append(
+                MessageEntityTextUrl(
+                    offset=offset,
+                    length=length,
+                    url="https://example.com",
+                ),
+            )
+
+    return text, entities
+
+
+def __synthetic_photo(rng: random.Random, photo_id: int, date: datetime) -> Photo:
+    return Photo(
+        id=photo_id,
+        access_hash=0,
+        file_reference=b"",
+        date=date,
+        sizes=[PhotoSize(type="y", w=1280, h=960, size=rng.randint(50, 300) * 1024)],
+        dc_id=2,
+    )
+
+
+def __synthetic_document(
+    rng: random.Random,
+    document_id: int,
+    date: datetime,
+) -> Document:
+    return Document(
+        id=document_id,
+        access_hash=0,
+        file_reference=b"",
+        date=date,
+        mime_type="application/pdf",
+        size=rng.randint(100, 8 * 1024) * 1024,
+        dc_id=2,
+        attributes=[DocumentAttributeFilename(file_name=f"file_{document_id}.pdf")],
+    )
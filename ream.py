@@ -6,36 +6,69 @@ Takes no arguments, since all configuration is provided through ream.toml.
 import asyncio
 import json
 import logging
+import time
 import tomllib
-from contextlib import suppress
+from collections.abc import AsyncIterator
 from pathlib import Path
-from typing import TYPE_CHECKING
-
-from telethon import TelegramClient
-from telethon.errors.rpcerrorlist import TakeoutInitDelayError
-from telethon.tl.types import User
-
-from serialization.serialization import serialize
-
-if TYPE_CHECKING:
-    from telethon.tl.custom.message import Message
-
+from typing import Any
+
+from telethon import TelegramClient, utils
+from telethon.errors.rpcerrorlist import TakeoutInitDelayError, TakeoutInvalidError
+from telethon.tl import functions
+from telethon.tl.custom.message import Message
+from telethon.tl.types import InputDialogPeer, InputUserSelf, User
+
+from serialization.batch_size import AdaptiveBatchSize
+from serialization.context import ExportContext
+from serialization.custom_emoji import CustomEmojiResolver
+from serialization.history import iter_history
+from serialization.media_queue import MediaQueue
+from serialization.metrics import Metrics, metrics
+from serialization.rate_limiter import RateLimitedClient, RateLimiter
+from serialization.scheduler import DownloadScheduler
+from serialization.serialization import download_queued_media, serialize_batch
+from storage.journal import MessageJournal
+from storage.media_store import MediaStore
 
 log = logging.getLogger(__name__)
 
-
-async def export(client: TelegramClient, chat: int) -> None:
+type SerializingBatch = tuple[
+    list[Message],
+    int,
+    asyncio.Task[list[dict[str, Any]]],
+]
+
+
+async def export(  # noqa: PLR0913
+    client: TelegramClient,
+    chat: int,
+    *,
+    scheduler: DownloadScheduler,
+    media_store: MediaStore | None,
+    custom_emoji: CustomEmojiResolver,
+    batch_size: int | AdaptiveBatchSize,
+) -> None:
     """Export data from a Telegram chat.
 
     Parameters
     ----------
     client : TelegramClient
-        The Telegram client.
+        The takeout client, which may be shared with other chat exports.
     chat : EntityLike
         The chat to export.
+    scheduler : DownloadScheduler
+        The scheduler shared by the downloads of all chats.
+    media_store : MediaStore | None
+        The store shared by the downloads of all chats, if enabled.
+    custom_emoji : CustomEmojiResolver
+        The custom emoji cache shared by all chats.
+    batch_size : int | AdaptiveBatchSize
+        How many messages are exported at once, either fixed or adapted to
+        the speed of the export.
 
     """
-    entity = await client.get_entity(chat)
+    with metrics.measure("get_entity"):
+        entity = await client.get_entity(chat)
 
     if not isinstance(entity, User):
         log.error("Chat %s is not a personal chat", chat)
@@ -52,77 +85,152 @@ async def export(client: TelegramClient, chat: int) -> None:
 
     path = Path(f"{config['export']['path']}/{entity.id}")
 
-    export_json = path / "export.json"
-
-    if export_json.exists():
-        chat_data = json.load(export_json.open())
-        last_message = chat_data["messages"][-1]["id"] if chat_data["messages"] else 0
-    else:
-        export_json.parent.mkdir(exist_ok=True, parents=True)
-        chat_data = {
+    # Files left in the queue by an earlier run are downloaded even if the
+    # media queue was turned off since, which queues the files of this run
+    # too. Otherwise, the chat would never stop counting as changed.
+    use_media_queue = config["export"].get("media_queue", False)
+    if not use_media_queue and (path / MediaQueue.JOURNAL_NAME).exists():
+        log.info("Downloading the files left in the media queue of chat %s", chat)
+        use_media_queue = True
+
+    context = ExportContext(
+        path,
+        download_part_size=config["export"].get(
+            "download_part_size",
+            ExportContext.download_part_size,
+        ),
+        download_connections=config["export"].get(
+            "download_connections",
+            ExportContext.download_connections,
+        ),
+        scheduler=scheduler,
+        media_queue=MediaQueue(path) if use_media_queue else None,
+        media_store=media_store,
+        custom_emoji=custom_emoji,
+    )
+    # Finding the files that were already downloaded takes a single pass
+    # over the export directory, instead of checking every file on its own.
+    await asyncio.to_thread(context.manifest.scan)
+
+    # Messages are appended to a journal, and export.json is only generated
+    # from it once all of them are saved.
+    journal = await asyncio.to_thread(
+        MessageJournal,
+        path,
+        {
             "name": entity.first_name,
             "type": "personal_chat",
             "id": entity.id,
-            "messages": [],
-        }
-        last_message = 0
-
-    # Close the takeout session if one is already open. If it's not open,
-    # `client.end_takeout` will raise a TypeError, so it's suppressed.
-    with suppress(TypeError):
-        await client.end_takeout(success=False)
-
-    takeout: TelegramClient
-    async with client.takeout(
-        contacts=True,
-        users=True,
-        files=True,
-        max_file_size=config["export"]["max_file_size"],
-    ) as takeout:
-        messages = takeout.iter_messages(
-            chat,
-            reverse=True,
-            offset_id=last_message,
-        )
-
-        batch_size = config["export"]["batch_size"]
-        batch = []
-
-        message: Message
-        async for message in messages:
-            batch.append(message)
-
-            if len(batch) >= batch_size:
-                tasks = [serialize(message, path) for message in batch]
-
-                chat_data["messages"] += await asyncio.gather(*tasks)
+        },
+    )
 
-                export_json.write_text(
-                    json.dumps(
-                        chat_data,
-                        indent=1,
-                        ensure_ascii=False,
-                    ),
-                    encoding="utf-8",
-                )
+    # Both users of a personal chat are known upfront, so serializing
+    # their messages never has to look them up.
+    context.entities.add([entity, await client.get_me()])
 
-                batch = []
-        if batch:
-            tasks = [serialize(message, path) for message in batch]
+    # Files queued in pipeline mode, including the ones left over from
+    # previous runs, are downloaded while the messages are exported.
+    media_downloads = asyncio.create_task(
+        download_queued_media(context, client, entity),
+    )
 
-            chat_data["messages"] += await asyncio.gather(*tasks)
+    messages = iter_history(
+        client,
+        chat,
+        offset_id=journal.last_message_id,
+        ranges=config["export"].get("parallel_fetches", 1),
+    )
 
-            export_json.write_text(
-                json.dumps(
-                    chat_data,
-                    indent=1,
-                    ensure_ascii=False,
-                ),
-                encoding="utf-8",
-            )
+    try:
+        await __export_messages(messages, journal, context, batch_size)
+    except BaseException:
+        media_downloads.cancel()
+        raise
+
+    if context.media_queue:
+        log.info("Waiting for the queued media of chat %s...", chat)
+        context.media_queue.close()
+    await media_downloads
+
+    if config["export"].get("write_export_json", True) and await asyncio.to_thread(
+        journal.outdated,
+    ):
+        with metrics.measure("write_export_json"):
+            await asyncio.to_thread(journal.materialize)
+
+    log.info("Finished exporting chat %s (@%s)", chat, username)
+
+
+async def __export_messages(
+    messages: AsyncIterator[Message],
+    journal: MessageJournal,
+    context: ExportContext,
+    batch_size: int | AdaptiveBatchSize,
+) -> None:
+    # Fetching, serializing and writing overlap: batches are serialized while
+    # the next ones are fetched, and written in order as soon as they are
+    # ready. The queue limits how many batches are serialized at once, so the
+    # fetching waits when serializing or writing can't keep up.
+    batches: asyncio.Queue[SerializingBatch | None] = asyncio.Queue(
+        config["export"].get("pipeline_depth", 2),
+    )
 
+    async with asyncio.TaskGroup() as tasks:
+        tasks.create_task(
+            __fetch_batches(messages, context, batch_size, tasks, batches),
+        )
 
-async def __main(client: TelegramClient) -> None:
+        written_at = time.monotonic()
+        while (item := await batches.get()) is not None:
+            batch, requested_size, serialized = item
+            serialized_batch = await serialized
+            # Encoding and writing happen in a thread, so downloads and
+            # requests keep going meanwhile.
+            with metrics.measure("write_journal"):
+                await asyncio.to_thread(journal.append, serialized_batch)
+
+            if isinstance(batch_size, AdaptiveBatchSize):
+                batch_size.update(
+                    batch,
+                    time.monotonic() - written_at,
+                    requested_size,
+                )
+            written_at = time.monotonic()
+
+
+async def __fetch_batches(
+    messages: AsyncIterator[Message],
+    context: ExportContext,
+    batch_size: int | AdaptiveBatchSize,
+    tasks: asyncio.TaskGroup,
+    batches: asyncio.Queue[SerializingBatch | None],
+) -> None:
+    # Every batch is queued with the size that it was requested with, since
+    # the adaptive size may have changed by the time the batch is written.
+    batch: list[Message] = []
+    fetched_at = time.monotonic()
+
+    message: Message
+    async for message in messages:
+        batch.append(message)
+
+        size = batch_size if isinstance(batch_size, int) else batch_size.size
+        if len(batch) >= size:
+            metrics.observe("fetch_batch", time.monotonic() - fetched_at)
+            serialized = tasks.create_task(serialize_batch(batch, context))
+            await batches.put((batch, size, serialized))
+            batch = []
+            fetched_at = time.monotonic()
+    if batch:
+        size = batch_size if isinstance(batch_size, int) else batch_size.size
+        metrics.observe("fetch_batch", time.monotonic() - fetched_at)
+        serialized = tasks.create_task(serialize_batch(batch, context))
+        await batches.put((batch, size, serialized))
+
+    await batches.put(None)
+
+
+async def __main(client: RateLimitedClient) -> None:
     if (
         "ream" in config
         and "log_level" in config["ream"]
@@ -140,26 +248,254 @@ async def __main(client: TelegramClient) -> None:
     else:
         logging.basicConfig(level=logging.INFO)
 
-    await client.get_dialogs()
+    metrics_interval = config.get("ream", {}).get("metrics_interval")
+    metrics_file = (
+        Path(config["ream"]["metrics_file"])
+        if "metrics_file" in config.get("ream", {})
+        else None
+    )
+    metrics_reports = (
+        asyncio.create_task(__report_metrics(metrics_interval, metrics_file))
+        if metrics_interval
+        else None
+    )
+
+    try:
+        await __export_chats(client)
+    finally:
+        if metrics_reports:
+            metrics_reports.cancel()
+        if metrics_interval or metrics_file:
+            __save_metrics(metrics_file)
+
+
+async def __export_chats(client: RateLimitedClient) -> None:
+    chats = await __resolve_chats(client, config["export"]["chats"])
+    chats = await __changed_chats(client, chats)
+    if not chats:
+        log.info("No chat has new messages")
+        return
+
+    scheduler = DownloadScheduler(
+        max_downloads=config["export"].get("max_concurrent_downloads", 8),
+        max_inflight_bytes=config["export"].get("max_inflight_bytes"),
+        max_bytes_per_second=config["export"].get("max_bytes_per_second"),
+    )
+
+    media_store = (
+        MediaStore(Path(config["export"]["media_store"]))
+        if "media_store" in config["export"]
+        else None
+    )
+
+    custom_emoji = CustomEmojiResolver(
+        Path(config["export"]["custom_emoji_cache"])
+        if "custom_emoji_cache" in config["export"]
+        else None,
+    )
+
+    batch_size = config["export"]["batch_size"]
+    if batch_size == "auto":
+        batch_size = AdaptiveBatchSize(client.rate_limiter)
+
+    # Chats are exported independently, so a slow chat doesn't hold back the
+    # others. The download limits still apply to all of them together.
+    parallel_chats = asyncio.Semaphore(config["export"].get("parallel_chats", 1))
+
+    async def export_chat(takeout: TelegramClient, chat: int) -> None:
+        # A chat that fails is logged and skipped, without cancelling the
+        # exports of the other chats.
+        async with parallel_chats:
+            try:
+                await export(
+                    takeout,
+                    chat,
+                    scheduler=scheduler,
+                    media_store=media_store,
+                    custom_emoji=custom_emoji,
+                    batch_size=batch_size,
+                )
+            except TakeoutInitDelayError:
+                raise
+            except Exception:
+                log.exception("Failed to export chat %s", chat)
+
+    # The takeout session is kept open after the export and reused by the
+    # next runs, since starting a new one takes extra requests and may have
+    # to be confirmed again. The session file remembers its id, and the
+    # options it was started with are kept next to it.
+    options = {
+        "contacts": True,
+        "users": True,
+        "files": True,
+        "max_file_size": config["export"]["max_file_size"],
+    }
+    options_file = Path(f"{client.session.filename}.takeout.json")  # type: ignore[attr-defined]
+    takeout_session = (
+        client.takeout(finalize=False)
+        if await __reuse_takeout(client, options, options_file)
+        else client.takeout(finalize=False, **options)
+    )
 
     try:
-        for chat in config["export"]["chats"]:
-            await export(client, chat)
+        takeout: TelegramClient
+        async with takeout_session as takeout:
+            await asyncio.to_thread(
+                options_file.write_text,
+                json.dumps(options),
+                encoding="utf-8",
+            )
+            async with asyncio.TaskGroup() as exports:
+                for chat in chats:
+                    exports.create_task(export_chat(takeout, chat))
     except TakeoutInitDelayError:
         log.info(
             "Please confirm the takeout session in your Telegram app and restart ream.",
         )
 
 
+async def __reuse_takeout(
+    client: TelegramClient,
+    options: dict[str, Any],
+    options_file: Path,
+) -> bool:
+    # Returns whether the takeout session of a previous run is still valid.
+    # Telegram rejects it once it expires or another export is started.
+    takeout_id = client.session.takeout_id  # type: ignore[attr-defined]
+    if takeout_id is None:
+        return False
+
+    # Telegram only takes the options when a takeout session is started, so
+    # changing them in the config needs a new one.
+    try:
+        previous_options = json.loads(
+            await asyncio.to_thread(options_file.read_text, encoding="utf-8"),
+        )
+    except FileNotFoundError:
+        previous_options = None
+    if previous_options != options:
+        log.info("The takeout options have changed, starting a new takeout session")
+        client.session.takeout_id = None  # type: ignore[attr-defined]
+        return False
+
+    try:
+        await client(
+            functions.InvokeWithTakeoutRequest(
+                takeout_id,
+                functions.users.GetUsersRequest([InputUserSelf()]),
+            ),
+        )
+    except TakeoutInvalidError:
+        log.info("The previous takeout session is no longer valid, starting a new one")
+        client.session.takeout_id = None  # type: ignore[attr-defined]
+        return False
+    return True
+
+
+async def __resolve_chats(client: TelegramClient, chats: list[int]) -> list[int]:
+    # Chats are exported by their id, which only works if the session knows
+    # their access hash. Most of them are known from previous runs, so the
+    # dialogs are only fetched for the others, and only until they're found,
+    # instead of fetching every dialog of the account on every run.
+    missing = set()
+    for chat in chats:
+        try:
+            await client.get_input_entity(chat)
+        except ValueError:
+            missing.add(chat)
+
+    if missing:
+        log.info("Looking up %s chats in the dialogs...", len(missing))
+        async for dialog in client.iter_dialogs():
+            missing.discard(dialog.id)
+            if not missing:
+                break
+
+    for chat in missing:
+        log.error("Chat %s was not found in the dialogs", chat)
+    return [chat for chat in chats if chat not in missing]
+
+
+async def __changed_chats(client: TelegramClient, chats: list[int]) -> list[int]:
+    # The dialogs tell the newest message of every chat, so a single request
+    # finds the chats without new messages, which don't need a takeout
+    # session at all.
+    top_messages: dict[int, int] = {}
+    for start in range(0, len(chats), __PEER_DIALOGS_LIMIT):
+        peers = [
+            InputDialogPeer(await client.get_input_entity(chat))
+            for chat in chats[start : start + __PEER_DIALOGS_LIMIT]
+        ]
+        result = await client(functions.messages.GetPeerDialogsRequest([*peers]))
+        for dialog in result.dialogs:
+            peer_id = utils.get_peer_id(dialog.peer)  # type: ignore[no-untyped-call]
+            top_messages[peer_id] = dialog.top_message
+
+    changed = []
+    for chat in chats:
+        path = Path(f"{config['export']['path']}/{chat}")
+        journal = await asyncio.to_thread(__open_journal, path)
+        last_message = journal.last_message_id if journal else 0
+        if (
+            top_messages.get(chat, last_message + 1) > last_message
+            or (path / MediaQueue.JOURNAL_NAME).exists()
+        ):
+            changed.append(chat)
+            continue
+
+        log.info("Chat %s has no new messages", chat)
+        # An export.json that is behind the journal, like after an
+        # interrupted run, is generated from it without a takeout session.
+        if (
+            journal
+            and config["export"].get("write_export_json", True)
+            and await asyncio.to_thread(journal.outdated)
+        ):
+            log.info("Generating export.json of chat %s from its journal", chat)
+            with metrics.measure("write_export_json"):
+                await asyncio.to_thread(journal.materialize)
+    return changed
+
+
+# How many chats the dialogs can be requested for at once
+__PEER_DIALOGS_LIMIT = 100
+
+
+def __open_journal(path: Path) -> MessageJournal | None:
+    try:
+        return MessageJournal(path)
+    except FileNotFoundError:
+        return None
+
+
+async def __report_metrics(interval: float, file: Path | None) -> None:
+    # The metrics are rendered on the event loop, which keeps updating them,
+    # and only written in a thread.
+    while True:
+        await asyncio.sleep(interval)
+        log.info("Time spent in each stage so far:\n%s", metrics.summary())
+        if file:
+            await asyncio.to_thread(Metrics.write, file, metrics.render(file))
+
+
+def __save_metrics(file: Path | None) -> None:
+    log.info("Time spent in each stage so far:\n%s", metrics.summary())
+    if file:
+        metrics.save(file)
+
+
 if __name__ == "__main__":
     with Path("ream.toml").open("rb") as f:
         config = tomllib.load(f)
 
-    client = TelegramClient(
+    client = RateLimitedClient(
         "ream",
         config["api"]["app_id"],
         config["api"]["app_hash"],
         app_version="1.0.0",
+        rate_limiter=RateLimiter(
+            config["export"].get("max_concurrent_requests", 16),
+        ),
     )
 
     with client:
@@ -29,14 +29,20 @@ from telethon.tl.types import (
     StarGiftUnique,
 )
 
-from ._helpers import __download_file, __serialize_peer, __serialize_reply
+from ._helpers import __download_file, __serialize_reply
 from ._text import __serialize_text
+from .context import ExportContext
+from .metrics import metrics
 
 __currencies_path = Path(__file__).parent / "currencies.json"
 __currencies = json.loads(__currencies_path.read_text(encoding="utf-8"))
 
 
-async def __serialize_action(message: Message, path: Path) -> dict[str, Any]:
+@metrics.timed("serialize_action")
+async def __serialize_action(
+    message: Message,
+    context: ExportContext,
+) -> dict[str, Any]:
     action = message.action
     data: dict[str, Any] = {}
     add_actor = True
@@ -67,14 +73,14 @@ async def __serialize_action(message: Message, path: Path) -> dict[str, Any]:
             add_actor = False
             data = {"distance": action.distance}
             if action.from_id:
-                peer_data = await __serialize_peer(
+                peer_data = await context.entities.peer(
                     message.client,
                     action.from_id,
                     "from",
                 )
                 data |= peer_data
             if action.to_id:
-                peer_data = await __serialize_peer(
+                peer_data = await context.entities.peer(
                     message.client,
                     action.to_id,
                     "to",
@@ -106,8 +112,10 @@ async def __serialize_action(message: Message, path: Path) -> dict[str, Any]:
 
             data["photo"] = await __download_file(
                 photo,
-                path / f"photos/{photo.id}.jpg",
+                context.path / f"photos/{photo.id}.jpg",
+                context,
                 client=message.client,
+                origin=message,
             )
 
             sizes = [size for size in photo.sizes if size.type != "i"]
@@ -153,11 +161,13 @@ async def __serialize_action(message: Message, path: Path) -> dict[str, Any]:
                 "stars": gift.stars,
                 "is_limited": gift.limited,
                 "is_anonymous": action.name_hidden,
-                "gift_text": await __serialize_text(
-                    action.message,
-                    path,
-                    client_override=message.client,
-                )
+                "gift_text": (
+                    await __serialize_text(
+                        action.message,
+                        context,
+                        client_override=message.client,
+                    )
+                )[0]
                 if action.message
                 else "",
             }
@@ -173,7 +183,11 @@ async def __serialize_action(message: Message, path: Path) -> dict[str, Any]:
             add_actor = False
 
     if add_actor and message.from_id:
-        data |= await __serialize_peer(message.client, message.from_id, "actor")
+        data |= await context.entities.peer(
+            message.client,
+            message.from_id,
+            "actor",
+        )
 
     return data
 
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import BinaryIO
+
+from telethon import TelegramClient
+from telethon.errors import FileReferenceExpiredError, FilerefUpgradeNeededError
+from telethon.tl.custom.message import Message
+from telethon.tl.types import Document, MessageMediaDocument, Photo, PhotoSize
+
+from .context import ExportContext
+
+log = logging.getLogger(__name__)
+
+# The biggest request size allowed by Telegram. Document parts must start at
+# a multiple of it, since a single request can't cross a 1 MB boundary.
+__REQUEST_SIZE = 512 * 1024
+
+
+def __resumable_document(
+    message: Message | Photo | Document,
+    thumb: PhotoSize | None,
+) -> Document | None:
+    if thumb:
+        return None
+    if isinstance(message, Document):
+        return message
+    if isinstance(message, Message) and isinstance(
+        message.media,
+        MessageMediaDocument,
+    ):
+        document = message.media.document
+        if isinstance(document, Document):
+            return document
+    return None
+
+
+def __media_size(
+    message: Message | Photo | Document,
+    thumb: PhotoSize | None,
+) -> int:
+    if thumb:
+        return int(thumb.size)
+    if isinstance(message, Document):
+        return int(message.size)
+    if isinstance(message, Photo):
+        return max(
+            (size.size for size in message.sizes if isinstance(size, PhotoSize)),
+            default=0,
+        )
+    return int(message.file.size or 0) if message.file else 0
+
+
+async def __download_media(
+    client: TelegramClient,
+    message: Message | Photo | Document,
+    part_file: Path,
+    context: ExportContext,
+    *,
+    thumb: PhotoSize | None = None,
+) -> bool:
+    downloaded = 0
+
+    async def progress(current: int, total: int | None) -> None:
+        nonlocal downloaded
+        log.info("Downloading %s: %s/%s", part_file.stem, current, total)
+        await context.scheduler.throttle(current - downloaded)
+        downloaded = current
+
+    with part_file.open("wb") as part:
+        result = await client.download_media(
+            message,
+            file=part,
+            thumb=thumb,
+            progress_callback=progress,
+        )
+        await asyncio.to_thread(__flush, part)
+
+    if result is None:
+        part_file.unlink()
+        return False
+    return True
+
+
+async def __download_document(
+    client: TelegramClient,
+    message: Message | Photo | Document,
+    document: Document,
+    part_file: Path,
+    context: ExportContext,
+) -> None:
+    part_size = __part_size(context)
+    part_count = max(1, math.ceil(document.size / part_size))
+
+    # The parts that were already downloaded are stored next to the partial
+    # file, so that an interrupted download can continue from there on the
+    # next run.
+    state_file = __state_file(part_file)
+
+    done = __load_done_parts(state_file, part_file, document, part_size)
+    if done:
+        log.info(
+            "Resuming download of %s, %s/%s parts done",
+            part_file.stem,
+            len(done),
+            part_count,
+        )
+    else:
+        with part_file.open("wb") as file:
+            file.truncate(document.size)
+
+    refresh_lock = asyncio.Lock()
+
+    async def refresh(expired: Document) -> bool:
+        # Downloads of large files can take long enough for the file
+        # reference to expire, in which case the message has to be fetched
+        # again to get a new one.
+        nonlocal message, document
+
+        async with refresh_lock:
+            # Another part may have already refreshed it
+            if document is not expired:
+                return True
+
+            if not isinstance(message, Message) or not message.input_chat:
+                return False
+
+            log.info("File reference expired for %s, refetching", part_file.stem)
+            refetched = await client.get_messages(message.input_chat, ids=message.id)
+            if not isinstance(refetched, Message):
+                return False
+
+            refreshed = __resumable_document(refetched, None)
+            if not refreshed or refreshed.id != document.id:
+                return False
+
+            message, document = refetched, refreshed
+            return True
+
+    # All workers share the same iterator, so each part is only taken once
+    pending = iter([index for index in range(part_count) if index not in done])
+
+    with part_file.open("r+b") as part:
+
+        async def download_parts() -> None:
+            for index in pending:
+                while True:
+                    current = document
+                    try:
+                        await __download_part(client, current, part, index, context)
+                        break
+                    except (FileReferenceExpiredError, FilerefUpgradeNeededError):
+                        if not await refresh(current):
+                            raise
+
+                await asyncio.to_thread(__flush, part)
+                done.add(index)
+                __save_done_parts(state_file, document, part_size, done)
+
+                log.info(
+                    "Downloading %s: %s/%s parts",
+                    part_file.stem,
+                    len(done),
+                    part_count,
+                )
+
+        workers = [
+            asyncio.create_task(download_parts())
+            for _ in range(max(1, min(context.download_connections, part_count)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    state_file.unlink(missing_ok=True)
+
+
+async def __download_part(
+    client: TelegramClient,
+    document: Document,
+    part: BinaryIO,
+    index: int,
+    context: ExportContext,
+) -> None:
+    part_size = __part_size(context)
+    offset = index * part_size
+
+    async for chunk in client.iter_download(
+        document,
+        offset=offset,
+        limit=part_size // __REQUEST_SIZE,
+        request_size=__REQUEST_SIZE,
+        file_size=document.size,
+    ):
+        # Parts are downloaded concurrently, but there is no await between
+        # seeking and writing, so they can't interfere with each other
+        part.seek(offset)
+        part.write(chunk)
+        offset += len(chunk)
+
+        await context.scheduler.throttle(len(chunk))
+
+
+def __flush(file: BinaryIO) -> None:
+    # Waiting for the disk can take a while, so this runs in a thread, while
+    # the other downloads and requests keep going.
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def __part_size(context: ExportContext) -> int:
+    part_size = context.download_part_size
+    return max(__REQUEST_SIZE, part_size - part_size % __REQUEST_SIZE)
+
+
+def __state_file(part_file: Path) -> Path:
+    return part_file.with_name(f"{part_file.name}.json")
+
+
+def __load_done_parts(
+    state_file: Path,
+    part_file: Path,
+    document: Document,
+    part_size: int,
+) -> set[int]:
+    if not state_file.exists() or not part_file.exists():
+        return set()
+
+    try:
+        state = json.loads(state_file.read_text(encoding="utf-8"))
+    except ValueError:
+        return set()
+
+    if (
+        state.get("id") != document.id
+        or state.get("size") != document.size
+        or state.get("part_size") != part_size
+        or part_file.stat().st_size != document.size
+    ):
+        return set()
+
+    return set(state["parts"])
+
+
+def __save_done_parts(
+    state_file: Path,
+    document: Document,
+    part_size: int,
+    done: set[int],
+) -> None:
+    temp_file = state_file.with_name(f"{state_file.name}.tmp")
+    temp_file.write_text(
+        json.dumps(
+            {
+                "id": document.id,
+                "size": document.size,
+                "part_size": part_size,
+                "parts": sorted(done),
+            },
+        ),
+        encoding="utf-8",
+    )
+    temp_file.replace(state_file)
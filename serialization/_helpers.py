@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from datetime import datetime
 from pathlib import Path
@@ -5,9 +6,27 @@ from typing import Any
 
 from telethon import TelegramClient
 from telethon.errors.rpcbaseerrors import BadRequestError
-from telethon.hints import EntitiesLike
+from telethon.hints import EntityLike
+from telethon.tl import functions
 from telethon.tl.custom.message import Message
-from telethon.tl.types import PeerChannel, PeerChat, PeerUser, Photo, PhotoSize, User
+from telethon.tl.types import (
+    Document,
+    PeerChannel,
+    PeerChat,
+    PeerUser,
+    Photo,
+    PhotoSize,
+)
+
+from ._download import (
+    __download_document,
+    __download_media,
+    __media_size,
+    __resumable_document,
+)
+from .context import ExportContext
+from .media_queue import QueuedMedia
+from .metrics import metrics
 
 log = logging.getLogger(__name__)
 
@@ -17,27 +36,6 @@ def __format_time(time: datetime) -> tuple[str, str]:
     return time.strftime("%Y-%m-%dT%H:%M:%S"), str(int(time.timestamp()))
 
 
-async def __serialize_peer(
-    client: TelegramClient,
-    peer: EntitiesLike,
-    prefix: str,
-) -> dict[str, str | int]:
-    entity = await client.get_entity(peer)
-
-    if not isinstance(entity, User):
-        raise TypeError
-
-    return {
-        prefix: " ".join(
-            filter(
-                None,
-                [entity.first_name, entity.last_name],
-            ),
-        ),
-        prefix + "_id": f"user{entity.id}",
-    }
-
-
 def __serialize_reply(
     message: Message,
     label: str = "reply_to_message_id",
@@ -60,53 +58,191 @@ def __serialize_reply(
     return data
 
 
-def __get_next_file_n(path: Path) -> int:
-    n = 1
-    for file in path.iterdir():
-        try:
-            file_n = int(file.stem.split("_")[1])
-            n = max(n, file_n + 1)
-        except (IndexError, ValueError):
-            continue
-    return n
-
-
-async def __download_file(
-    message: Message | Photo,
+async def __download_file(  # noqa: PLR0913
+    message: Message | Photo | Document,
     file: Path,
+    context: ExportContext,
     *,
     thumb: PhotoSize | None = None,
     client: TelegramClient | None = None,
+    origin: Message | None = None,
 ) -> str:
     dl_client = client or getattr(message, "client", None)
     if not isinstance(dl_client, TelegramClient):
         raise MissingClientError
 
-    if not file.exists():
-        try:
-            content = await dl_client.download_media(
-                message,
-                file=bytes,
-                thumb=thumb,
-                progress_callback=lambda current, total: log.info(
-                    "Downloading %s: %s/%s",
-                    file.name,
-                    current,
-                    total,
+    relative_path = Path(file.parent.name) / file.name
+
+    if not context.manifest.exists(file):
+        # In pipeline mode the file is downloaded in the background, since its
+        # path doesn't depend on the download result.
+        if context.media_queue:
+            context.media_queue.put(
+                QueuedMedia(
+                    file.relative_to(context.path),
+                    __media_source(message, thumb, origin),
+                    message,
+                    thumb,
                 ),
             )
-        except BadRequestError:
+        elif not await __fetch_file(message, file, context, dl_client, thumb):
             return "(File unavailable, please try again later)"
 
-        # Telethon allows to download media directly to a file, but that way
-        # the file would be created even before the media is fully downloaded,
-        # so the download won't be resumed after an interruption.
-        file.parent.mkdir(exist_ok=True, parents=True)
-        file.write_bytes(content)
+    return relative_path.as_posix()
 
-    relative_path = Path(file.parent.name) / file.name
 
-    return relative_path.as_posix()
+async def __fetch_file(
+    message: Message | Photo | Document,
+    file: Path,
+    context: ExportContext,
+    client: TelegramClient,
+    thumb: PhotoSize | None = None,
+) -> bool:
+    # Messages of a batch are serialized concurrently and may share a file,
+    # like a custom emoji, which must only be downloaded once at a time.
+    if (download := context.downloads.get(file)) is None:
+        download = asyncio.create_task(
+            __fetch_new_file(message, file, context, client, thumb),
+        )
+        context.downloads[file] = download
+        download.add_done_callback(lambda _: context.downloads.pop(file, None))
+    return await download
+
+
+async def __fetch_new_file(
+    message: Message | Photo | Document,
+    file: Path,
+    context: ExportContext,
+    client: TelegramClient,
+    thumb: PhotoSize | None,
+) -> bool:
+    context.manifest.mkdir(file.parent)
+    if context.media_store:
+        available = await context.media_store.fetch(
+            file,
+            lambda stored: __transfer_file(message, stored, context, client, thumb),
+        )
+    else:
+        available = await __transfer_file(message, file, context, client, thumb)
+
+    if available:
+        context.manifest.add(file)
+    return available
+
+
+async def __transfer_file(
+    message: Message | Photo | Document,
+    file: Path,
+    context: ExportContext,
+    client: TelegramClient,
+    thumb: PhotoSize | None,
+) -> bool:
+    # Telethon allows to download media directly to the target file, but
+    # that way the file would be created even before the media is fully
+    # downloaded, so the download won't be resumed after an interruption.
+    # Instead, the media is streamed to a temporary file that only gets
+    # its final name once it's complete and flushed to disk. Partially
+    # downloaded documents are kept between runs and resumed.
+    part_file = file.with_name(f"{file.name}.part")
+    size = __media_size(message, thumb)
+    try:
+        async with context.scheduler.download(size):
+            with metrics.measure("download") as stage:
+                if document := __resumable_document(message, thumb):
+                    await __download_document(
+                        client,
+                        message,
+                        document,
+                        part_file,
+                        context,
+                    )
+                elif not await __download_media(
+                    client,
+                    message,
+                    part_file,
+                    context,
+                    thumb=thumb,
+                ):
+                    return False
+    except BadRequestError:
+        return False
+
+    part_file.replace(file)
+    stage.bytes += size
+    return True
+
+
+async def __download_queued(
+    item: QueuedMedia,
+    context: ExportContext,
+    client: TelegramClient,
+    chat: EntityLike,
+) -> None:
+    media, thumb = item.media, item.thumb
+    if media is None:
+        media, thumb = await __resolve_queued(item.source, client, chat)
+
+    if media is None or not await __fetch_file(
+        media,
+        context.path / item.file,
+        context,
+        client,
+        thumb,
+    ):
+        log.warning("File %s is unavailable, skipping", item.file)
+
+
+async def __resolve_queued(
+    source: dict[str, Any],
+    client: TelegramClient,
+    chat: EntityLike,
+) -> tuple[Message | Photo | Document | None, PhotoSize | None]:
+    if "emoji" in source:
+        documents = await client(
+            functions.messages.GetCustomEmojiDocumentsRequest(
+                document_id=[source["emoji"]],
+            ),
+        )
+        return (documents[0] if documents else None), None
+
+    message = await client.get_messages(chat, ids=source["message"])
+    if not isinstance(message, Message):
+        return None, None
+
+    if source.get("action"):
+        photo = getattr(message.action, "photo", None)
+        return (photo if isinstance(photo, Photo) else None), None
+
+    if thumb_type := source.get("thumb"):
+        thumbs = message.document.thumbs if message.document else None
+        thumb = next(
+            (
+                thumb
+                for thumb in thumbs or []
+                if isinstance(thumb, PhotoSize) and thumb.type == thumb_type
+            ),
+            None,
+        )
+        return (message if thumb else None), thumb
+
+    return message, None
+
+
+def __media_source(
+    message: Message | Photo | Document,
+    thumb: PhotoSize | None,
+    origin: Message | None,
+) -> dict[str, Any]:
+    match message:
+        case Message():
+            return {"message": message.id} | ({"thumb": thumb.type} if thumb else {})
+        case Photo() if origin:
+            return {"message": origin.id, "action": True}
+        case Document():
+            # Documents are only downloaded directly for custom emoji
+            return {"emoji": message.id}
+    msg = f"Can't queue the download of {message!r}"
+    raise TypeError(msg)
 
 
 class MissingClientError(Exception):
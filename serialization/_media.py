@@ -1,5 +1,4 @@
 import logging
-from pathlib import Path
 from typing import Any
 
 from telethon.tl.custom.message import Message
@@ -23,8 +22,10 @@ from telethon.tl.types import (
     PhotoSize,
 )
 
-from ._helpers import __download_file, __get_next_file_n
+from ._helpers import __download_file
 from ._phone import __format_phone
+from .context import ExportContext
+from .metrics import metrics
 
 log = logging.getLogger(__name__)
 
@@ -37,7 +38,11 @@ type DocumentAttribute = (
 )
 
 
-async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
+@metrics.timed("serialize_media")
+async def __serialize_media(
+    message: Message,
+    context: ExportContext,
+) -> dict[str, Any]:
     media = message.media
     if not media:
         return {}
@@ -50,7 +55,8 @@ async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
             if photo:
                 data["photo"] = await __download_file(
                     message,
-                    path / f"photos/{photo.id}{message.file.ext}",
+                    context.path / f"photos/{photo.id}{message.file.ext}",
+                    context,
                 )
                 data["width"] = message.file.width
                 data["height"] = message.file.height
@@ -61,7 +67,7 @@ async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
             if media.ttl_seconds:
                 data["self_destruct_period_seconds"] = media.ttl_seconds
         case MessageMediaDocument():
-            data |= await __serialize_document(message, path)
+            data |= await __serialize_document(message, context)
             if media.spoiler:
                 data["media_spoiler"] = True
             if media.ttl_seconds:
@@ -73,12 +79,13 @@ async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
                 "phone_number": __format_phone(media.phone_number),
             }
             if media.vcard:
-                contacts_dir = path / "contacts"
-                contacts_dir.mkdir(parents=True, exist_ok=True)
+                contacts_dir = context.path / "contacts"
+                context.manifest.mkdir(contacts_dir)
 
-                n = __get_next_file_n(contacts_dir)
+                n = context.manifest.next_number(contacts_dir)
                 vcard_file = contacts_dir / f"contact_{n}.vcard"
                 vcard_file.write_text(media.vcard)
+                context.manifest.add(vcard_file)
 
                 data["contact_vcard"] = f"contacts/contact_{n}.vcard"
         case MessageMediaGeo():
@@ -105,7 +112,10 @@ async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
             data["game_title"] = game.title
             data["game_description"] = game.description
             if message.via_bot_id and game.short_name:
-                bot = await message.client.get_entity(message.via_bot_id)
+                bot = await context.entities.user(
+                    message.client,
+                    message.via_bot_id,
+                )
                 if bot.bot and bot.username:
                     data["game_link"] = (
                         f"https://t.me/{bot.username}?game={game.short_name}"
@@ -120,7 +130,10 @@ async def __serialize_media(message: Message, path: Path) -> dict[str, Any]:
     return data
 
 
-async def __serialize_document(message: Message, path: Path) -> dict[str, Any]:
+async def __serialize_document(
+    message: Message,
+    context: ExportContext,
+) -> dict[str, Any]:
     assert isinstance(message.media, MessageMediaDocument)  # noqa: S101
 
     file = message.file
@@ -169,7 +182,8 @@ async def __serialize_document(message: Message, path: Path) -> dict[str, Any]:
 
     data["file"] = await __download_file(
         message,
-        path / directory / f"{document.id}{ext}",
+        context.path / directory / f"{document.id}{ext}",
+        context,
     )
 
     if document.thumbs:
@@ -177,7 +191,8 @@ async def __serialize_document(message: Message, path: Path) -> dict[str, Any]:
             if isinstance(thumb, PhotoSize):
                 data["thumbnail"] = await __download_file(
                     message,
-                    path / directory / f"{document.id}{file.ext}_thumb.jpg",
+                    context.path / directory / f"{document.id}{file.ext}_thumb.jpg",
+                    context,
                     thumb=thumb,
                 )
                 break
@@ -1,4 +1,3 @@
-from pathlib import Path
 from typing import Any
 
 from telethon import TelegramClient
@@ -6,7 +5,6 @@ from telethon.helpers import (
     add_surrogate,
     del_surrogate,
 )
-from telethon.tl import functions
 from telethon.tl.custom.message import Message
 from telethon.tl.types import (
     MessageEntityBankCard,
@@ -33,15 +31,20 @@ from telethon.tl.types import (
 )
 
 from ._helpers import MissingClientError, __download_file
+from .context import ExportContext
+from .metrics import metrics
 
 
+@metrics.timed("serialize_text")
 async def __serialize_text(
     message: Message | TextWithEntities,
-    path: Path,
+    context: ExportContext,
     *,
-    serialize_entities: bool = False,
     client_override: TelegramClient | None = None,
-) -> str | list[str | dict[str, Any]]:
+) -> tuple[str | list[str | dict[str, Any]], list[dict[str, Any]]]:
+    # Both the "text" value, where plain text is kept as strings, and the
+    # "text_entities" value, where every part of the text is a typed entity,
+    # are built in a single pass over the entities.
     client = getattr(message, "client", client_override)
     if not isinstance(client, TelegramClient):
         raise MissingClientError
@@ -50,13 +53,12 @@ async def __serialize_text(
     text = message.raw_text if isinstance(message, Message) else message.text
 
     if not entities:
-        if serialize_entities:
-            return [{"type": "plain", "text": text}] if text else []
-        return text or ""
+        return text or "", [{"type": "plain", "text": text}] if text else []
 
-    text = add_surrogate(text)
+    surrogate_text = add_surrogate(text)
 
-    text_entities: list[str | dict[str, Any]] = []
+    text_parts: list[str | dict[str, Any]] = []
+    text_entities: list[dict[str, Any]] = []
     last_offset = 0
 
     for entity in entities:
@@ -65,19 +67,15 @@ async def __serialize_text(
         start = entity.offset
         end = start + entity.length
         if start > last_offset:
-            plain = del_surrogate(text[last_offset:start])
-            text_entities.append(
-                {
-                    "type": "plain",
-                    "text": plain,
-                }
-                if serialize_entities
-                else plain,
+            __append_plain(
+                text_parts,
+                text_entities,
+                del_surrogate(surrogate_text[last_offset:start]),
             )
         elif start < last_offset:
             continue
 
-        inner_text = del_surrogate(text[start:end])
+        inner_text = del_surrogate(surrogate_text[start:end])
         last_offset = end
         data = {
             "type": entity_type,
@@ -88,70 +86,76 @@ async def __serialize_text(
             case MessageEntityMentionName():
                 data["user_id"] = entity.user_id
             case MessageEntityCustomEmoji():
-                emoji_data = await client(
-                    functions.messages.GetCustomEmojiDocumentsRequest(
-                        document_id=[entity.document_id],
-                    ),
-                )
-
-                match emoji_data[0].mime_type:
-                    case "image/webp":
-                        directory = "stickers"
-                        extension = "webp"
-                    case "video/webm":
-                        directory = "video_files"
-                        extension = "webm"
-                    case "application/x-tgsticker":
-                        directory = "stickers"
-                        extension = "tgs"
-
-                emoji_dir = path / directory
-                emoji_dir.mkdir(parents=True, exist_ok=True)
-
-                file = emoji_dir / f"{entity.document_id}.{extension}"
-
-                data["document_id"] = await __download_file(
-                    emoji_data[0],
-                    file,
-                    client=client,
+                data["document_id"] = await __download_custom_emoji(
+                    entity.document_id,
+                    context,
+                    client,
                 )
             case MessageEntityPre():
                 data["language"] = entity.language
             case MessageEntityTextUrl():
                 data["href"] = entity.url
 
+        text_parts.append(data)
         text_entities.append(data)
 
-    if last_offset < len(text):
-        plain = del_surrogate(text[last_offset:])
-        text_entities.append(
-            {
-                "type": "plain",
-                "text": plain,
-            }
-            if serialize_entities
-            else plain,
+    if last_offset < len(surrogate_text):
+        __append_plain(
+            text_parts,
+            text_entities,
+            del_surrogate(surrogate_text[last_offset:]),
         )
 
-    text = del_surrogate(text)
-
     # Replicate a bug in tdesktop export where unicode in the message
     # causes an empty string to be added at the end
-    if (
-        len(text) != len(text.encode())
-        and not isinstance(text_entities[-1], str)
-        and text_entities[-1]["type"] != "plain"
-    ):
-        text_entities.append(
-            {
-                "type": "plain",
-                "text": "",
-            }
-            if serialize_entities
-            else "",
-        )
-
-    return text_entities
+    if len(text) != len(text.encode()) and text_entities[-1]["type"] != "plain":
+        __append_plain(text_parts, text_entities, "")
+
+    return text_parts, text_entities
+
+
+def __append_plain(
+    text_parts: list[str | dict[str, Any]],
+    text_entities: list[dict[str, Any]],
+    plain: str,
+) -> None:
+    text_parts.append(plain)
+    text_entities.append({"type": "plain", "text": plain})
+
+
+@metrics.timed("custom_emoji")
+async def __download_custom_emoji(
+    document_id: int,
+    context: ExportContext,
+    client: TelegramClient,
+) -> str:
+    mime_type = await context.custom_emoji.mime_type(client, document_id)
+    if mime_type is None:
+        return "(File unavailable, please try again later)"
+
+    match mime_type:
+        case "image/webp":
+            directory = "stickers"
+            extension = "webp"
+        case "video/webm":
+            directory = "video_files"
+            extension = "webm"
+        case "application/x-tgsticker":
+            directory = "stickers"
+            extension = "tgs"
+
+    file = context.path / directory / f"{document_id}.{extension}"
+
+    # The document itself is only needed if the file wasn't downloaded yet,
+    # which saves a request when the mime type is cached on disk.
+    if context.manifest.exists(file):
+        return f"{directory}/{file.name}"
+
+    document = await context.custom_emoji.document(client, document_id)
+    if document is None:
+        return "(File unavailable, please try again later)"
+
+    return await __download_file(document, file, context, client=client)
 
 
 __entity_types = {
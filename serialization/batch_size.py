@@ -0,0 +1,103 @@
+"""Provides the "AdaptiveBatchSize" class that tunes the export batch size."""
+
+import logging
+
+from telethon.tl.custom.message import Message
+
+from .rate_limiter import RateLimiter
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveBatchSize:
+    """Adapts how many messages are exported at once to the observed speed.
+
+    After every batch, the size grows as long as the export gets faster and
+    steps back once it gets slower, so it settles around the fastest size.
+    It's halved whenever a flood wait happened during the batch, and lowered
+    when a batch had so much media that it would take too long to download.
+
+    A single instance is meant to be shared by all exports of an account,
+    since they are all subject to the same limits.
+
+    Parameters
+    ----------
+    rate_limiter : RateLimiter
+        The rate limiter of the client, used to notice flood waits.
+
+    size : int
+        The size of the first batch.
+
+    Attributes
+    ----------
+    size : int
+        How many messages should be in the next batch.
+
+    """
+
+    _MIN_SIZE = 10
+    _MAX_SIZE = 1000
+    _GROWTH = 1.25
+    # How much slower a batch may be than the previous one before the size
+    # steps back, so that noise in the timing doesn't shrink the batches.
+    _TOLERANCE = 0.9
+    _MAX_MEDIA_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, rate_limiter: RateLimiter, size: int = 100) -> None:
+        self.size = size
+
+        self._rate_limiter = rate_limiter
+        self._flood_waits = rate_limiter.flood_waits
+        self._last_rate = 0.0
+
+    def update(
+        self,
+        messages: list[Message],
+        seconds: float,
+        requested_size: int,
+    ) -> None:
+        """Adjust the size after a batch was exported.
+
+        Parameters
+        ----------
+        messages : list[Message]
+            The messages of the batch.
+
+        seconds : float
+            How long it took to export the batch, since the previous one.
+
+        requested_size : int
+            The size that was asked for when the batch was fetched. It may
+            differ from the current size, since batches are fetched ahead.
+
+        """
+        # Smaller batches, like the last one of a chat, took less time just
+        # because they have fewer messages, so they aren't comparable.
+        if len(messages) < requested_size:
+            return
+
+        rate = len(messages) / seconds if seconds > 0 else float("inf")
+        media_bytes = sum(
+            message.file.size or 0 for message in messages if message.file
+        )
+        flood_waits = self._rate_limiter.flood_waits
+
+        if flood_waits > self._flood_waits:
+            size = self.size // 2
+            # The batch was slowed down by the flood wait, so its speed can't
+            # be compared to the next one.
+            rate = 0.0
+        elif media_bytes > self._MAX_MEDIA_BYTES:
+            size = self.size * self._MAX_MEDIA_BYTES // media_bytes
+        elif rate >= self._last_rate * self._TOLERANCE:
+            size = int(self.size * self._GROWTH)
+        else:
+            size = int(self.size / self._GROWTH)
+
+        self._flood_waits = flood_waits
+        self._last_rate = rate
+
+        size = max(self._MIN_SIZE, min(self._MAX_SIZE, size))
+        if size != self.size:
+            log.debug("Changing the batch size from %s to %s", self.size, size)
+            self.size = size
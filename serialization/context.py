@@ -0,0 +1,75 @@
+"""Provides the "ExportContext" class that holds the state of a chat export."""
+
+import asyncio
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from storage.manifest import ExportManifest
+from storage.media_store import MediaStore
+
+from .custom_emoji import CustomEmojiResolver
+from .entity_cache import EntityCache
+from .media_queue import MediaQueue
+from .scheduler import DownloadScheduler
+
+
+@dataclass
+class ExportContext:
+    """Settings and shared state used while exporting a single chat.
+
+    Attributes
+    ----------
+    path : Path
+        The directory that the export is saved to. This is used to store
+        all the files and media.
+
+    download_part_size : int
+        The size of the parts that documents are split into when they are
+        downloaded. Rounded down to a multiple of 512 KB.
+
+    download_connections : int
+        How many parts of a single document are downloaded concurrently.
+
+    scheduler : DownloadScheduler
+        Limits the downloads of all files. Share a single scheduler between
+        exports to apply its limits globally.
+
+    media_queue : MediaQueue | None
+        If set, files aren't downloaded while messages are serialized. They
+        are added to this queue instead, to be downloaded in the background.
+
+    media_store : MediaStore | None
+        If set, files are downloaded into this store once and linked into
+        the export directory from there.
+
+    custom_emoji : CustomEmojiResolver
+        Resolves and caches custom emoji documents. Share a single resolver
+        between exports to reuse its cache.
+
+    entities : EntityCache
+        Caches the users that appear in the export.
+
+    downloads : dict[Path, asyncio.Task[bool]]
+        The files that are being downloaded right now, so that messages
+        sharing a file don't download it at the same time.
+
+    manifest : ExportManifest
+        The files that are already in the export directory. Created from
+        the path.
+
+    """
+
+    path: Path
+    download_part_size: int = 16 * 1024 * 1024
+    download_connections: int = 1
+    scheduler: DownloadScheduler = field(default_factory=DownloadScheduler)
+    media_queue: MediaQueue | None = None
+    media_store: MediaStore | None = None
+    custom_emoji: CustomEmojiResolver = field(default_factory=CustomEmojiResolver)
+    entities: EntityCache = field(default_factory=EntityCache)
+    downloads: dict[Path, asyncio.Task[bool]] = field(default_factory=dict)
+    manifest: ExportManifest = field(init=False)
+
+    def __post_init__(self) -> None:
+        """Create the manifest of the export directory."""
+        self.manifest = ExportManifest(self.path)
@@ -0,0 +1,189 @@
+"""Provides the "CustomEmojiResolver" class that caches custom emoji."""
+
+import asyncio
+import json
+import logging
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+from telethon import TelegramClient
+from telethon.tl import functions
+from telethon.tl.custom.message import Message
+from telethon.tl.types import (
+    Document,
+    MessageActionStarGift,
+    MessageEntityCustomEmoji,
+    StarGift,
+)
+
+log = logging.getLogger(__name__)
+
+
+class CustomEmojiResolver:
+    """Resolves custom emoji documents with as few requests as possible.
+
+    Documents are requested for a whole batch of messages at once. Their mime
+    types, which determine the paths of the emoji files, are cached for as
+    long as the resolver exists, and can also be cached on disk, so that
+    emoji that were already downloaded don't need any requests at all. The
+    documents themselves are only cached for a short while, since the file
+    references that they are downloaded with expire. Emoji that Telegram
+    doesn't return are remembered too, so they're only requested once.
+
+    Parameters
+    ----------
+    cache_file : Path | None
+        The file that mime types are cached in. Not cached on disk if None.
+
+    """
+
+    # The maximum amount of documents in a single request allowed by Telegram
+    _REQUEST_LIMIT = 200
+
+    # How many seconds a document is used before it's requested again, well
+    # below the lifetime of its file reference
+    _DOCUMENT_LIFETIME = 15 * 60
+
+    def __init__(self, cache_file: Path | None = None) -> None:
+        self.cache_file = cache_file
+
+        # The documents along with the time they were requested at
+        self._documents: dict[int, tuple[float, Document]] = {}
+        self._mime_types: dict[int, str] = {}
+        self._missing: set[int] = set()
+        self._lock = asyncio.Lock()
+
+        if cache_file and cache_file.exists():
+            cache = json.loads(cache_file.read_text(encoding="utf-8"))
+            self._mime_types = {int(key): value for key, value in cache.items()}
+
+    async def prefetch(self, messages: Iterable[Message]) -> None:
+        """Request the custom emoji of all messages that aren't cached yet.
+
+        Parameters
+        ----------
+        messages : Iterable[Message]
+            The messages whose custom emoji are requested, using their client.
+
+        """
+        client = None
+        document_ids: set[int] = set()
+        for message in messages:
+            client = message.client
+            for entities in (
+                message.entities,
+                self._gift_entities(message),
+            ):
+                document_ids.update(
+                    entity.document_id
+                    for entity in entities or []
+                    if isinstance(entity, MessageEntityCustomEmoji)
+                )
+
+        document_ids -= self._mime_types.keys() | self._missing
+        if client and document_ids:
+            await self._request(client, document_ids)
+
+    async def mime_type(self, client: TelegramClient, document_id: int) -> str | None:
+        """Get the mime type of a custom emoji.
+
+        Parameters
+        ----------
+        client : TelegramClient
+            The client used to request the document if it's not cached.
+
+        document_id : int
+            The id of the custom emoji document.
+
+        Returns
+        -------
+        str | None
+            The mime type, or None if the document doesn't exist.
+
+        """
+        if document_id not in self._mime_types and document_id not in self._missing:
+            await self._request(client, {document_id})
+        return self._mime_types.get(document_id)
+
+    async def document(
+        self,
+        client: TelegramClient,
+        document_id: int,
+    ) -> Document | None:
+        """Get a custom emoji document.
+
+        Parameters
+        ----------
+        client : TelegramClient
+            The client used to request the document if it's not cached.
+
+        document_id : int
+            The id of the custom emoji document.
+
+        Returns
+        -------
+        Document | None
+            The document, or None if it doesn't exist.
+
+        """
+        if document_id in self._missing:
+            return None
+        if document_id not in self._fresh_documents():
+            await self._request(client, {document_id})
+        requested = self._documents.get(document_id)
+        return requested[1] if requested else None
+
+    def _fresh_documents(self) -> set[int]:
+        expires_before = time.monotonic() - self._DOCUMENT_LIFETIME
+        return {
+            document_id
+            for document_id, (requested_at, _) in self._documents.items()
+            if requested_at > expires_before
+        }
+
+    async def _request(self, client: TelegramClient, document_ids: set[int]) -> None:
+        async with self._lock:
+            # Another caller may have requested the same documents meanwhile
+            ids = sorted(document_ids - self._fresh_documents() - self._missing)
+            if not ids:
+                return
+
+            for start in range(0, len(ids), self._REQUEST_LIMIT):
+                chunk = ids[start : start + self._REQUEST_LIMIT]
+                documents = await client(
+                    functions.messages.GetCustomEmojiDocumentsRequest(
+                        document_id=chunk,
+                    ),
+                )
+                requested_at = time.monotonic()
+                returned = set()
+                for document in documents:
+                    if isinstance(document, Document):
+                        self._documents[document.id] = (requested_at, document)
+                        self._mime_types[document.id] = document.mime_type
+                        returned.add(document.id)
+                self._missing.update(set(chunk) - returned)
+
+            log.info("Requested %s custom emoji documents", len(ids))
+
+            if self.cache_file:
+                self._save(self.cache_file)
+
+    @staticmethod
+    def _gift_entities(message: Message) -> list[object] | None:
+        # Star gifts have their own text, which may have custom emoji too
+        action = getattr(message, "action", None)
+        if (
+            isinstance(action, MessageActionStarGift)
+            and isinstance(action.gift, StarGift)
+            and action.message
+        ):
+            return list(action.message.entities or [])
+        return None
+
+    def _save(self, cache_file: Path) -> None:
+        cache_file.parent.mkdir(exist_ok=True, parents=True)
+        temp_file = cache_file.with_name(f"{cache_file.name}.tmp")
+        temp_file.write_text(json.dumps(self._mime_types), encoding="utf-8")
+        temp_file.replace(cache_file)
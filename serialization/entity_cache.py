@@ -0,0 +1,120 @@
+"""Provides the "EntityCache" class that caches the users of a chat export."""
+
+from collections.abc import Iterable, Mapping
+
+from telethon import TelegramClient, utils
+from telethon.hints import EntityLike
+from telethon.tl.custom.message import Message
+from telethon.tl.types import User
+
+
+class EntityCache:
+    """Caches the users that appear in a chat export.
+
+    A personal chat only involves a handful of users, so every user is
+    looked up once and reused for all messages. The cache is filled from
+    the users that Telegram returns along with the messages, so lookups
+    usually don't need any requests or session database queries at all.
+    """
+
+    def __init__(self) -> None:
+        self._users: dict[int, User] = {}
+        self._peers: dict[tuple[int, str], dict[str, str | int]] = {}
+
+    def add(self, entities: Iterable[object]) -> None:
+        """Add users to the cache.
+
+        Parameters
+        ----------
+        entities : Iterable[object]
+            The entities to add. Everything that isn't a user is ignored.
+
+        """
+        for entity in entities:
+            if isinstance(entity, User) and not entity.min:
+                self._users[entity.id] = entity
+
+    def add_messages(self, messages: Iterable[Message]) -> None:
+        """Add the users that were returned along with messages to the cache.
+
+        Parameters
+        ----------
+        messages : Iterable[Message]
+            The messages whose senders, bots and action users are added.
+
+        """
+        for message in messages:
+            self.add([message.sender, message.via_bot])
+            self.add(message.action_entities or [])
+            if message.forward:
+                self.add([message.forward.sender])
+
+    async def user(self, client: TelegramClient, peer: EntityLike) -> User:
+        """Get a user, requesting it only if it isn't cached yet.
+
+        Parameters
+        ----------
+        client : TelegramClient
+            The client used to request the user if it's not cached.
+
+        peer : EntityLike
+            The user to get.
+
+        Returns
+        -------
+        User
+            The user.
+
+        Raises
+        ------
+        TypeError
+            If the peer is not a user.
+
+        """
+        peer_id = utils.get_peer_id(peer)  # type: ignore[no-untyped-call]
+        if peer_id not in self._users:
+            entity = await client.get_entity(peer)
+            if not isinstance(entity, User):
+                raise TypeError
+            self._users[peer_id] = entity
+        return self._users[peer_id]
+
+    async def peer(
+        self,
+        client: TelegramClient,
+        peer: EntityLike,
+        prefix: str,
+    ) -> Mapping[str, str | int]:
+        """Get the serialized name and id of a user.
+
+        Parameters
+        ----------
+        client : TelegramClient
+            The client used to request the user if it's not cached.
+
+        peer : EntityLike
+            The user to serialize.
+
+        prefix : str
+            The key of the name, like "from" or "actor". The key of the id is
+            the prefix followed by "_id".
+
+        Returns
+        -------
+        Mapping[str, str | int]
+            The name and id of the user, to be merged into a message.
+
+        """
+        key = (utils.get_peer_id(peer), prefix)  # type: ignore[no-untyped-call]
+        if key not in self._peers:
+            entity = await self.user(client, peer)
+            self._peers[key] = {
+                prefix: " ".join(
+                    filter(
+                        None,
+                        [entity.first_name, entity.last_name],
+                    ),
+                ),
+                prefix + "_id": f"user{entity.id}",
+            }
+        return self._peers[key]
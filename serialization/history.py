@@ -0,0 +1,113 @@
+"""Provides the "iter_history" function to fetch messages in parallel."""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator
+
+from telethon import TelegramClient
+from telethon.hints import EntityLike
+from telethon.tl.custom.message import Message
+
+log = logging.getLogger(__name__)
+
+
+async def iter_history(
+    client: TelegramClient,
+    chat: EntityLike,
+    offset_id: int = 0,
+    ranges: int = 1,
+    buffer_size: int = 1000,
+) -> AsyncIterator[Message]:
+    """Iterate over the messages of a chat from oldest to newest.
+
+    The ids after the offset are split into ranges that are fetched at the
+    same time, and the messages of each range are yielded once all ranges
+    before it are done, so they are still in order.
+
+    Parameters
+    ----------
+    client : TelegramClient
+        The client used to fetch the messages.
+
+    chat : EntityLike
+        The chat whose messages are fetched.
+
+    offset_id : int
+        Only messages with a higher id than this are fetched.
+
+    ranges : int
+        How many ranges of ids are fetched at the same time.
+
+    buffer_size : int
+        How many messages of a range may be fetched before they are yielded.
+        Ranges whose buffer is full wait for the ranges before them.
+
+    Yields
+    ------
+    Message
+        The messages of the chat, from oldest to newest.
+
+    """
+    if ranges <= 1:
+        async for message in client.iter_messages(
+            chat,
+            reverse=True,
+            offset_id=offset_id,
+        ):
+            yield message
+        return
+
+    newest_id = offset_id
+    async for message in client.iter_messages(chat, limit=1):
+        newest_id = message.id
+    if newest_id <= offset_id:
+        return
+
+    # Message ids aren't contiguous, but splitting them evenly still gives
+    # every range a similar share of the messages in most chats.
+    step = max(1, -(-(newest_id - offset_id) // ranges))
+    bounds = [
+        (start, min(start + step, newest_id))
+        for start in range(offset_id, newest_id, step)
+    ]
+    log.debug("Fetching messages in ranges %s", bounds)
+
+    buffers = [asyncio.Queue[Message | None](buffer_size) for _ in bounds]
+    tasks = [
+        asyncio.create_task(__fetch_range(client, chat, start, end, buffer))
+        for (start, end), buffer in zip(bounds, buffers, strict=True)
+    ]
+
+    try:
+        for buffer, task in zip(buffers, tasks, strict=True):
+            while (message := await buffer.get()) is not None:
+                yield message
+            # If the range failed, the messages after it must not be yielded,
+            # since the export would have a gap.
+            await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def __fetch_range(
+    client: TelegramClient,
+    chat: EntityLike,
+    start: int,
+    end: int,
+    buffer: asyncio.Queue[Message | None],
+) -> None:
+    messages = client.iter_messages(
+        chat,
+        reverse=True,
+        offset_id=start,
+        max_id=end + 1,
+    )
+    try:
+        async for message in messages:
+            await buffer.put(message)
+    except Exception:
+        # Let the consumer reach the end of the range and see the error
+        await buffer.put(None)
+        raise
+    await buffer.put(None)
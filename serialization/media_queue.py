@@ -0,0 +1,160 @@
+"""Provides the "MediaQueue" class that stores the files waiting for download."""
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from telethon.tl.custom.message import Message
+from telethon.tl.types import Document, Photo, PhotoSize
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class QueuedMedia:
+    """A file that is waiting to be downloaded.
+
+    Attributes
+    ----------
+    file : Path
+        Where the file is saved, relative to the export directory.
+
+    source : dict[str, Any]
+        Where the file comes from. It's stored on disk, so that the media can
+        be fetched again after a restart. Contains either a "message" id,
+        optionally with a "thumb" type or an "action" flag for service message
+        photos, or an "emoji" document id.
+
+    media : Message | Photo | Document | None
+        The media to download, or None if it has to be fetched again.
+
+    thumb : PhotoSize | None
+        The thumbnail to download instead of the media itself.
+
+    """
+
+    file: Path
+    source: dict[str, Any]
+    media: Message | Photo | Document | None = None
+    thumb: PhotoSize | None = None
+
+
+class MediaQueue:
+    """A persistent queue of files waiting to be downloaded.
+
+    Every queued file is recorded in a journal in the export directory until
+    it's downloaded, so files that were queued but not downloaded before an
+    interruption are queued again on the next run.
+
+    Parameters
+    ----------
+    path : Path
+        The directory that the export is saved to.
+
+    """
+
+    # The name of the journal in the export directory
+    JOURNAL_NAME = ".media_queue.jsonl"
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.journal = path / self.JOURNAL_NAME
+
+        self._queue: asyncio.Queue[QueuedMedia | None] = asyncio.Queue()
+        self._pending: set[Path] = set()
+        self._closed = False
+
+        if self.journal.exists():
+            self._restore()
+
+    def put(self, item: QueuedMedia) -> None:
+        """Add a file to the queue, unless it's already queued.
+
+        Parameters
+        ----------
+        item : QueuedMedia
+            The file to download.
+
+        """
+        if item.file in self._pending:
+            return
+
+        self._write({"file": item.file.as_posix(), "source": item.source})
+        self._pending.add(item.file)
+        self._queue.put_nowait(item)
+
+    async def get(self) -> QueuedMedia | None:
+        """Wait for the next file to download.
+
+        Returns
+        -------
+        QueuedMedia | None
+            The next file, or None once the queue is closed and empty.
+
+        """
+        item = await self._queue.get()
+        if item is None:
+            # Let the other consumers know that the queue is closed too
+            self._queue.put_nowait(None)
+        return item
+
+    def done(self, item: QueuedMedia) -> None:
+        """Mark a file as downloaded, so it isn't queued again.
+
+        Parameters
+        ----------
+        item : QueuedMedia
+            The file that was downloaded.
+
+        """
+        self._pending.discard(item.file)
+        if self._pending or not self._closed:
+            self._write({"done": item.file.as_posix()})
+        else:
+            self.journal.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        """Stop accepting files, letting consumers finish the queued ones."""
+        self._closed = True
+        self._queue.put_nowait(None)
+        if not self._pending:
+            self.journal.unlink(missing_ok=True)
+
+    def _restore(self) -> None:
+        sources: dict[Path, dict[str, Any]] = {}
+        with self.journal.open(encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete after an interruption
+                    continue
+                if "done" in entry:
+                    sources.pop(Path(entry["done"]), None)
+                else:
+                    sources[Path(entry["file"])] = entry["source"]
+
+        log.info("Restored %s queued files in %s", len(sources), self.path)
+
+        # Compact the journal, so that it only has the files that are pending
+        compacted = self.journal.with_name(f"{self.journal.name}.tmp")
+        compacted.write_text(
+            "".join(
+                json.dumps({"file": file.as_posix(), "source": source}) + "\n"
+                for file, source in sources.items()
+            ),
+            encoding="utf-8",
+        )
+        compacted.replace(self.journal)
+
+        for file, source in sources.items():
+            self._pending.add(file)
+            self._queue.put_nowait(QueuedMedia(file, source))
+
+    def _write(self, entry: dict[str, Any]) -> None:
+        self.journal.parent.mkdir(exist_ok=True, parents=True)
+        with self.journal.open("a", encoding="utf-8") as journal:
+            journal.write(json.dumps(entry) + "\n")
@@ -0,0 +1,347 @@
+"""Provides the "metrics" that record where the time of an export is spent."""
+
+import bisect
+import functools
+import json
+import time
+from collections.abc import Callable, Coroutine, Generator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+type CoroutineFunction[**P, T] = Callable[P, Coroutine[Any, Any, T]]
+
+# The upper bounds of the latency histogram buckets, in seconds
+_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+
+@dataclass
+class Stage:
+    """The measurements of a single stage of the export.
+
+    Attributes
+    ----------
+    count : int
+        How many times the stage ran.
+
+    seconds : float
+        How long all runs of the stage took together.
+
+    bytes : int
+        How many bytes the stage transferred.
+
+    buckets : list[int]
+        How many runs fell into each latency bucket, from the fastest one.
+        The last bucket counts the runs that were slower than all of them.
+
+    """
+
+    count: int = 0
+    seconds: float = 0
+    bytes: int = 0
+    buckets: list[int] = field(default_factory=lambda: [0] * (len(_BUCKETS) + 1))
+
+    def observe(self, seconds: float) -> None:
+        """Record a run of the stage.
+
+        Parameters
+        ----------
+        seconds : float
+            How long the run took.
+
+        """
+        self.count += 1
+        self.seconds += seconds
+        self.buckets[bisect.bisect_left(_BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile of the run durations.
+
+        Parameters
+        ----------
+        q : float
+            The quantile, between 0 and 1.
+
+        Returns
+        -------
+        float
+            The upper bound of the bucket that contains the quantile, or
+            infinity if it's above the largest bucket.
+
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(_BUCKETS, self.buckets, strict=False):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Counts, latencies and transferred bytes of every stage of the export.
+
+    Stages are named freely, like "serialize_media" or
+    "request:GetHistoryRequest", and created when they're first measured.
+
+    Attributes
+    ----------
+    stages : dict[str, Stage]
+        The measurements of every stage, by name.
+
+    flood_waits : int
+        How many flood waits the requests ran into.
+
+    flood_wait_seconds : float
+        How long all flood waits were together.
+
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, Stage] = {}
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+
+    @contextmanager
+    def measure(self, stage: str) -> Generator[Stage]:
+        """Measure how long the body of a "with" statement takes.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+
+        Yields
+        ------
+        Stage
+            The measurements of the stage, to add transferred bytes to.
+
+        """
+        measurements = self.stages.setdefault(stage, Stage())
+        started_at = time.monotonic()
+        try:
+            yield measurements
+        finally:
+            measurements.observe(time.monotonic() - started_at)
+
+    def observe(self, stage: str, seconds: float) -> Stage:
+        """Record a run of a stage that was timed elsewhere.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+
+        seconds : float
+            How long the run took.
+
+        Returns
+        -------
+        Stage
+            The measurements of the stage.
+
+        """
+        measurements = self.stages.setdefault(stage, Stage())
+        measurements.observe(seconds)
+        return measurements
+
+    def timed[**P, T](
+        self,
+        stage: str,
+    ) -> Callable[[CoroutineFunction[P, T]], CoroutineFunction[P, T]]:
+        """Measure every call of a coroutine function.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+
+        Returns
+        -------
+        Callable[[CoroutineFunction[P, T]], CoroutineFunction[P, T]]
+            A decorator for the function.
+
+        """
+
+        def decorator(
+            function: CoroutineFunction[P, T],
+        ) -> CoroutineFunction[P, T]:
+            @functools.wraps(function)
+            async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+                with self.measure(stage):
+                    return await function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def flood_wait(self, seconds: float) -> None:
+        """Record a flood wait.
+
+        Parameters
+        ----------
+        seconds : float
+            How long requests had to wait.
+
+        """
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+
+    def summary(self) -> str:
+        """Summarize the metrics for the log.
+
+        Returns
+        -------
+        str
+            One line per stage, slowest stage first. Stages whose first run
+            hasn't finished yet are left out.
+
+        """
+        lines = [
+            f"{self.flood_waits} flood waits, {self.flood_wait_seconds:.0f} s",
+        ]
+        stages = sorted(
+            self.stages.items(),
+            key=lambda item: item[1].seconds,
+            reverse=True,
+        )
+        for name, stage in stages:
+            if not stage.count:
+                continue
+            line = (
+                f"{name}: {stage.count} times, {stage.seconds:.1f} s total, "
+                f"{stage.seconds / stage.count * 1000:.1f} ms on average, "
+                f"p95 <= {stage.quantile(0.95) * 1000:.0f} ms"
+            )
+            if stage.bytes:
+                line += f", {stage.bytes / 1024 / 1024:.1f} MB"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_json(self) -> dict[str, Any]:
+        """Convert the metrics to a JSON object.
+
+        Returns
+        -------
+        dict[str, Any]
+            The metrics, with the histogram buckets keyed by their bounds.
+
+        """
+        return {
+            "flood_waits": self.flood_waits,
+            "flood_wait_seconds": self.flood_wait_seconds,
+            "stages": {
+                name: {
+                    "count": stage.count,
+                    "seconds": stage.seconds,
+                    "bytes": stage.bytes,
+                    "buckets": dict(
+                        zip(
+                            [*map(str, _BUCKETS), "+Inf"],
+                            stage.buckets,
+                            strict=True,
+                        ),
+                    ),
+                }
+                for name, stage in self.stages.items()
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """Convert the metrics to the Prometheus text format.
+
+        Returns
+        -------
+        str
+            The metrics, with the latencies as cumulative histograms.
+
+        """
+        lines = [
+            "# TYPE ream_flood_waits_total counter",
+            f"ream_flood_waits_total {self.flood_waits}",
+            "# TYPE ream_flood_wait_seconds_total counter",
+            f"ream_flood_wait_seconds_total {self.flood_wait_seconds}",
+            "# TYPE ream_stage_seconds histogram",
+        ]
+        for name, stage in self.stages.items():
+            label = json.dumps(name)
+            cumulative = 0
+            for bound, count in zip(
+                [*map(str, _BUCKETS), "+Inf"],
+                stage.buckets,
+                strict=True,
+            ):
+                cumulative += count
+                lines.append(
+                    f'ream_stage_seconds_bucket{{stage={label},le="{bound}"}} '
+                    f"{cumulative}",
+                )
+            lines += [
+                f"ream_stage_seconds_sum{{stage={label}}} {stage.seconds}",
+                f"ream_stage_seconds_count{{stage={label}}} {stage.count}",
+            ]
+
+        lines.append("# TYPE ream_stage_bytes_total counter")
+        lines += [
+            f"ream_stage_bytes_total{{stage={json.dumps(name)}}} {stage.bytes}"
+            for name, stage in self.stages.items()
+            if stage.bytes
+        ]
+        return "\n".join(lines) + "\n"
+
+    def render(self, path: Path) -> str:
+        """Convert the metrics to the format of a file.
+
+        The stages keep changing while the export runs, so this has to be
+        called from the event loop, unlike "write".
+
+        Parameters
+        ----------
+        path : Path
+            The file that the metrics are written to. JSON is used if its
+            name ends with ".json", and the Prometheus text format otherwise.
+
+        Returns
+        -------
+        str
+            The content of the file.
+
+        """
+        if path.suffix == ".json":
+            return json.dumps(self.to_json(), indent=1)
+        return self.to_prometheus()
+
+    @staticmethod
+    def write(path: Path, content: str) -> None:
+        """Write rendered metrics to a file.
+
+        The file is replaced at once, so a scraper never reads half of it.
+
+        Parameters
+        ----------
+        path : Path
+            The file to write.
+
+        content : str
+            The metrics, as returned by "render".
+
+        """
+        temporary = path.with_name(f"{path.name}.tmp")
+        temporary.write_text(content, encoding="utf-8")
+        temporary.replace(path)
+
+    def save(self, path: Path) -> None:
+        """Write the metrics to a file.
+
+        Parameters
+        ----------
+        path : Path
+            The file to write, in the format chosen by "render".
+
+        """
+        self.write(path, self.render(path))
+
+
+# The metrics of the running export, shared by all of its stages
+metrics = Metrics()
@@ -0,0 +1,200 @@
+"""Provides the "RateLimiter" class that adapts requests to flood waits."""
+
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
+
+from telethon import TelegramClient
+from telethon.errors import FloodPremiumWaitError, FloodWaitError
+from telethon.network.mtprotosender import MTProtoSender
+from telethon.sessions.abstract import Session
+from telethon.tl.tlobject import TLRequest
+
+from .metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Limits how many requests are sent to Telegram at once.
+
+    When any request gets a flood wait, all requests are paused until it's
+    over and the limit is halved. Every successful request then raises the
+    limit a bit again, until it's back at the maximum. This keeps the
+    request rate close to what Telegram allows, instead of repeatedly
+    running into flood waits.
+
+    Parameters
+    ----------
+    max_requests : int
+        The maximum number of requests that are sent at the same time.
+
+    Attributes
+    ----------
+    flood_waits : int
+        How many flood waits the requests have run into so far.
+
+    """
+
+    # Requests made while sending another request, like resolving its
+    # entities, must not wait for a slot, since they'd wait for themselves.
+    _sending: ContextVar[bool] = ContextVar("sending", default=False)
+
+    def __init__(self, max_requests: int = 16) -> None:
+        self.max_requests = max_requests
+        self.flood_waits = 0
+
+        self._limit = float(max_requests)
+        self._requests = 0
+        self._slots = asyncio.Condition()
+
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+
+    @property
+    def limit(self) -> int:
+        """The number of requests that are currently allowed at once."""
+        return int(self._limit)
+
+    async def run[T](self, request: Callable[[], Awaitable[T]]) -> T:
+        """Send a request, retrying it after flood waits.
+
+        Parameters
+        ----------
+        request : Callable[[], Awaitable[T]]
+            Sends the request. Called again for every retry.
+
+        Returns
+        -------
+        T
+            The result of the request.
+
+        """
+        if self._sending.get():
+            return await request()
+
+        while True:
+            await self._acquire()
+            started_at = time.monotonic()
+            token = self._sending.set(True)
+            try:
+                result = await request()
+            except (FloodWaitError, FloodPremiumWaitError) as e:
+                self._flood_wait(e.seconds, started_at)
+                continue
+            finally:
+                self._sending.reset(token)
+                await self._release()
+
+            self._limit = min(self.max_requests, self._limit + 1 / self._limit)
+            return result
+
+    async def _acquire(self) -> None:
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            async with self._slots:
+                await self._slots.wait_for(lambda: self._requests < self.limit)
+                # The requests may have been paused while waiting for a slot
+                if self._paused_until <= time.monotonic():
+                    self._requests += 1
+                    return
+
+    async def _release(self) -> None:
+        async with self._slots:
+            self._requests -= 1
+            self._slots.notify_all()
+
+    def _flood_wait(self, seconds: int, started_at: float) -> None:
+        self.flood_waits += 1
+        metrics.flood_wait(seconds)
+
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+
+        # Requests that were sent before the limit was last lowered ran into
+        # the same flood wait, so the limit is only lowered once for them.
+        if started_at >= self._decreased_at:
+            self._limit = max(1.0, self._limit / 2)
+            self._decreased_at = now
+            log.warning(
+                "Flood wait, pausing all requests for %s seconds and lowering "
+                "the limit to %s concurrent requests",
+                seconds,
+                self.limit,
+            )
+
+
+class RateLimitedClient(TelegramClient):
+    """A Telegram client that sends all of its requests through a rate limiter.
+
+    This includes the requests of iterators and file downloads, so flood
+    waits are never raised by this client. They are waited out by the rate
+    limiter instead.
+
+    Parameters
+    ----------
+    session : str | Session
+        The name of the session file, or the session itself.
+
+    api_id : int
+        The API id of the application.
+
+    api_hash : str
+        The API hash of the application.
+
+    app_version : str
+        The version of the application.
+
+    rate_limiter : RateLimiter
+        The rate limiter that the requests are sent through.
+
+    """
+
+    def __init__(
+        self,
+        session: str | Session,
+        api_id: int,
+        api_hash: str,
+        *,
+        app_version: str,
+        rate_limiter: RateLimiter,
+    ) -> None:
+        # Telethon sleeps through short flood waits by itself, which would
+        # hide them from the rate limiter.
+        super().__init__(
+            session,
+            api_id,
+            api_hash,
+            app_version=app_version,
+            flood_sleep_threshold=0,
+        )
+        self.rate_limiter = rate_limiter
+
+    async def _call(
+        self,
+        sender: MTProtoSender,
+        request: TLRequest,
+        ordered: bool = False,  # noqa: FBT001, FBT002
+        flood_sleep_threshold: int | None = None,
+    ) -> object:
+        call = super()._call
+        # Measured from before waiting for the rate limiter, so that the time
+        # spent in flood waits shows up in the request that ran into them.
+        with metrics.measure(f"request:{type(request).__name__}") as stage:
+            result = await self.rate_limiter.run(
+                lambda: call(
+                    sender,
+                    request,
+                    ordered=ordered,
+                    flood_sleep_threshold=flood_sleep_threshold,
+                ),
+            )
+            if isinstance(file := getattr(result, "bytes", None), bytes):
+                stage.bytes += len(file)
+        return result
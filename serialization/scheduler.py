@@ -0,0 +1,104 @@
+"""Provides the "DownloadScheduler" class that limits concurrent downloads."""
+
+import asyncio
+import time
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+
+class DownloadScheduler:
+    """Limits how many files are downloaded at once and how fast.
+
+    A single scheduler is meant to be shared by everything that downloads
+    files, so that the limits apply globally no matter how many messages are
+    serialized at once.
+
+    Parameters
+    ----------
+    max_downloads : int | None
+        How many files may be downloaded at the same time. Unlimited if None.
+
+    max_inflight_bytes : int | None
+        The maximum total size of the files that are being downloaded at the
+        same time. A file bigger than this limit is still downloaded, but
+        only when no other downloads are running. Unlimited if None.
+
+    max_bytes_per_second : int | None
+        The maximum download speed for all files combined. Unlimited if None.
+
+    """
+
+    def __init__(
+        self,
+        max_downloads: int | None = None,
+        max_inflight_bytes: int | None = None,
+        max_bytes_per_second: int | None = None,
+    ) -> None:
+        self.max_downloads = max_downloads
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_bytes_per_second = max_bytes_per_second
+
+        self._downloads = 0
+        self._inflight_bytes = 0
+        self._slots = asyncio.Condition()
+
+        self._tokens = float(max_bytes_per_second or 0)
+        self._refilled_at = time.monotonic()
+        self._rate_lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def download(self, size: int) -> AsyncGenerator[None]:
+        """Wait until a file of the given size may be downloaded.
+
+        Parameters
+        ----------
+        size : int
+            The size of the file in bytes, or 0 if it's unknown.
+
+        """
+        if self.max_inflight_bytes:
+            size = min(size, self.max_inflight_bytes)
+
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._has_room(size))
+            self._downloads += 1
+            self._inflight_bytes += size
+
+        try:
+            yield
+        finally:
+            async with self._slots:
+                self._downloads -= 1
+                self._inflight_bytes -= size
+                self._slots.notify_all()
+
+    async def throttle(self, size: int) -> None:
+        """Wait until the given amount of downloaded data fits the speed limit.
+
+        Parameters
+        ----------
+        size : int
+            How many bytes were just downloaded.
+
+        """
+        rate = self.max_bytes_per_second
+        if not rate:
+            return
+
+        async with self._rate_lock:
+            now = time.monotonic()
+            self._tokens = min(rate, self._tokens + (now - self._refilled_at) * rate)
+            self._refilled_at = now
+
+            self._tokens -= size
+            if self._tokens < 0:
+                await asyncio.sleep(-self._tokens / rate)
+
+    def _has_room(self, size: int) -> bool:
+        if self.max_downloads and self._downloads >= self.max_downloads:
+            return False
+        return not (
+            self.max_inflight_bytes
+            and self._downloads
+            and self._inflight_bytes + size > self.max_inflight_bytes
+        )
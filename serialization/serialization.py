@@ -2,10 +2,10 @@
 
 import asyncio
 import logging
-from pathlib import Path
 from typing import Any
 
-from telethon.errors import FloodWaitError
+from telethon import TelegramClient
+from telethon.hints import EntityLike
 from telethon.tl.custom.message import Message
 from telethon.tl.types import (
     MessageService,
@@ -14,14 +14,21 @@ from telethon.tl.types import (
 
 from ._action import __serialize_action
 from ._buttons import __serialize_buttons
-from ._helpers import __format_time, __serialize_peer, __serialize_reply
+from ._helpers import (
+    __download_queued,
+    __format_time,
+    __serialize_reply,
+)
 from ._media import __serialize_media
 from ._text import __serialize_text
+from .context import ExportContext
+from .metrics import metrics
 
 log = logging.getLogger(__name__)
 
 
-async def serialize(message: Message, path: Path) -> dict[str, Any]:
+@metrics.timed("serialize")
+async def serialize(message: Message, context: ExportContext) -> dict[str, Any]:
     """Serialize a Telegram message into a json-like object.
 
     Parameters
@@ -29,9 +36,8 @@ async def serialize(message: Message, path: Path) -> dict[str, Any]:
     message : Message
         The message to serialize.
 
-    path : Path
-        The directory that the export is saved to. This is used to store
-        all the files and media.
+    context : ExportContext
+        The settings and state of the export that the message belongs to.
 
     Returns
     -------
@@ -39,15 +45,6 @@ async def serialize(message: Message, path: Path) -> dict[str, Any]:
         The serialized message.
 
     """
-    try:
-        return await __try_serialize(message, path)
-    except FloodWaitError as e:
-        log.warning("Flood wait, waiting for: %s", e.seconds)
-        await asyncio.sleep(e.seconds)
-        return await serialize(message, path)
-
-
-async def __try_serialize(message: Message, path: Path) -> dict[str, Any]:
     log.info("Serializing message %s", message.id)
 
     if not message.from_id:
@@ -73,9 +70,9 @@ async def __try_serialize(message: Message, path: Path) -> dict[str, Any]:
         data["edited_unixtime"] = edit_date_unixtime
 
     if message_type == "service":
-        data |= await __serialize_action(message, path)
+        data |= await __serialize_action(message, context)
     else:
-        data |= await __serialize_peer(message.client, message.from_id, "from")
+        data |= await context.entities.peer(message.client, message.from_id, "from")
 
         if forward := message.forward:
             if sender := forward.sender:
@@ -97,20 +94,90 @@ async def __try_serialize(message: Message, path: Path) -> dict[str, Any]:
         data |= __serialize_reply(message)
 
         if message.via_bot_id:
-            bot = await message.client.get_entity(message.via_bot_id)
+            bot = await context.entities.user(message.client, message.via_bot_id)
             if bot.username:
                 data["via_bot"] = f"@{bot.username}"
 
-    data |= await __serialize_media(message, path)
+    data |= await __serialize_media(message, context)
 
-    data["text"] = await __serialize_text(message, path)
-    data["text_entities"] = await __serialize_text(
-        message,
-        path,
-        serialize_entities=True,
-    )
+    data["text"], data["text_entities"] = await __serialize_text(message, context)
 
     if isinstance(message.reply_markup, ReplyInlineMarkup):
         data["inline_bot_buttons"] = __serialize_buttons(message.reply_markup.rows)
 
     return data
+
+
+@metrics.timed("serialize_batch")
+async def serialize_batch(
+    messages: list[Message],
+    context: ExportContext,
+) -> list[dict[str, Any]]:
+    """Serialize a batch of Telegram messages concurrently.
+
+    Data that is shared by the messages, like their users and custom emoji
+    documents, is cached for the whole batch at once before serializing them.
+
+    Parameters
+    ----------
+    messages : list[Message]
+        The messages to serialize.
+
+    context : ExportContext
+        The settings and state of the export that the messages belong to.
+
+    Returns
+    -------
+    list[dict[str, Any]]
+        The serialized messages, in the same order.
+
+    """
+    context.entities.add_messages(messages)
+    await context.custom_emoji.prefetch(messages)
+
+    return await asyncio.gather(*(serialize(message, context) for message in messages))
+
+
+async def download_queued_media(
+    context: ExportContext,
+    client: TelegramClient,
+    chat: EntityLike,
+    workers: int = 8,
+) -> None:
+    """Download the files that were queued while serializing messages.
+
+    Runs until the media queue of the context is closed and every queued file
+    is processed. Files that fail to download stay in the queue, so they are
+    retried on the next run.
+
+    Parameters
+    ----------
+    context : ExportContext
+        The export whose media queue is processed.
+
+    client : TelegramClient
+        The client used to download the files.
+
+    chat : EntityLike
+        The exported chat, used to fetch the messages of files that were
+        queued in a previous run.
+
+    workers : int
+        How many files are processed at once. The actual downloads are also
+        limited by the scheduler of the context.
+
+    """
+    queue = context.media_queue
+    if not queue:
+        return
+
+    async def worker() -> None:
+        while (item := await queue.get()) is not None:
+            try:
+                await __download_queued(item, context, client, chat)
+            except Exception:
+                log.exception("Failed to download %s, will retry later", item.file)
+                continue
+            queue.done(item)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
@@ -0,0 +1 @@
+"""Provides writers for the files that make up a chat export."""
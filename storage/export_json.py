@@ -0,0 +1,202 @@
+"""Provides an append-only writer for the export.json file of a chat.
+
+The file is kept byte-identical to what
+``json.dumps(chat_data, indent=1, ensure_ascii=False)`` would produce, but new
+messages are written in place at the end of the "messages" array instead of
+re-serializing the whole chat after every batch.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import IO, Any
+
+log = logging.getLogger(__name__)
+
+
+class ExportJsonWriter:
+    """Append-only writer for a tdesktop-compatible export.json file.
+
+    The file is only created once the first messages are appended. If the file
+    already exists, its header is kept and new messages are added after the
+    existing ones. A file that was left incomplete by an interrupted write is
+    truncated back to its last complete message.
+
+    Opening an existing file only reads its last few messages, so the cost
+    doesn't depend on the size of the export.
+
+    Encoding and writing messages blocks, so async code should run the writer
+    in a thread, one call at a time.
+
+    Parameters
+    ----------
+    path : Path
+        The export.json file.
+
+    chat : dict[str, Any]
+        The chat information that is written before the messages when the file
+        is created.
+
+    """
+
+    # The messages array always sits at the end of the file, so everything
+    # after the last message is one of these two tails.
+    _EMPTY_TAIL = b"]\n}"
+    _TAIL = b"\n ]\n}"
+
+    # Messages are nested two levels deep, so a line that starts with exactly
+    # two spaces followed by a closing brace can only be the end of a message.
+    _MESSAGE_ENDS = (b"\n  }", b"\n  {}")
+    _MESSAGE_START = b"\n  {"
+
+    _ARRAY_START = b'"messages": ['
+
+    _SCAN_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, path: Path, chat: dict[str, Any]) -> None:
+        self.path = path
+        self._chat = chat
+        self._end = 0
+        self._empty = True
+
+        self.last_message_id = 0
+        """The id of the last message in the file, or 0 if there are none."""
+
+        if path.exists():
+            with path.open("r+b") as file:
+                self._recover(file)
+                self.last_message_id = self._find_last_message_id(file)
+
+    def append(self, messages: list[dict[str, Any]]) -> None:
+        """Append messages to the end of the "messages" array.
+
+        The file is flushed to disk before returning, so the messages are
+        never lost once this method completes.
+
+        Parameters
+        ----------
+        messages : list[dict[str, Any]]
+            The serialized messages.
+
+        """
+        if not messages:
+            return
+
+        if not self.path.exists():
+            self._create()
+
+        chunk = ",\n  ".join(
+            json.dumps(message, indent=1, ensure_ascii=False).replace("\n", "\n  ")
+            for message in messages
+        ).encode()
+        chunk = (b"\n  " if self._empty else b",\n  ") + chunk
+
+        with self.path.open("r+b") as file:
+            file.seek(self._end)
+            file.write(chunk + self._TAIL)
+            file.truncate()
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._end += len(chunk)
+        self._empty = False
+
+        for message in reversed(messages):
+            if "id" in message:
+                self.last_message_id = message["id"]
+                break
+
+    def _create(self) -> None:
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+
+        header = json.dumps(
+            self._chat | {"messages": []},
+            indent=1,
+            ensure_ascii=False,
+        ).encode()
+        header = header.removesuffix(self._EMPTY_TAIL)
+
+        with self.path.open("wb") as file:
+            file.write(header + self._EMPTY_TAIL)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._end = len(header)
+        self._empty = True
+
+    def _recover(self, file: IO[bytes]) -> None:
+        size = file.seek(0, os.SEEK_END)
+
+        file.seek(max(0, size - len(self._ARRAY_START + self._EMPTY_TAIL)))
+        tail = file.read()
+
+        if tail.endswith(self._TAIL):
+            self._end = size - len(self._TAIL)
+            self._empty = False
+            return
+        if tail.endswith(self._ARRAY_START + self._EMPTY_TAIL):
+            self._end = size - len(self._EMPTY_TAIL)
+            self._empty = True
+            return
+
+        log.warning("%s is incomplete, recovering the last complete message", self.path)
+
+        ends = [
+            index + len(needle)
+            for needle in self._MESSAGE_ENDS
+            if (index := self._rfind(file, needle, size)) >= 0
+        ]
+        if ends:
+            self._end = max(ends)
+            self._empty = False
+            tail = self._TAIL
+        else:
+            file.seek(0)
+            header = file.read(self._SCAN_BLOCK_SIZE)
+            start = header.find(self._ARRAY_START)
+            if start < 0:
+                msg = f"{self.path} is not a chat export"
+                raise ValueError(msg)
+            self._end = start + len(self._ARRAY_START)
+            self._empty = True
+            tail = self._EMPTY_TAIL
+
+        file.seek(self._end)
+        file.write(tail)
+        file.truncate()
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _find_last_message_id(self, file: IO[bytes]) -> int:
+        # Messages that failed to serialize are written as empty objects, so
+        # walk back until a message that has an id.
+        end = self._end
+        while not self._empty:
+            start = self._rfind(file, self._MESSAGE_START, end)
+            if start < 0:
+                break
+
+            file.seek(start)
+            message = json.loads(file.read(end - start))
+            if "id" in message:
+                return int(message["id"])
+
+            # Skip the comma that separates the message from the previous one
+            end = start - 1
+        return 0
+
+    def _rfind(self, file: IO[bytes], needle: bytes, end: int) -> int:
+        # Returns the offset of the last occurrence of the needle before end,
+        # reading the file backwards in blocks, or -1 if there is none.
+        position = end
+        while position > 0:
+            start = max(0, position - self._SCAN_BLOCK_SIZE)
+            file.seek(start)
+            # Overlap the blocks so that a needle on a block boundary is found
+            block = file.read(min(position + len(needle) - 1, end) - start)
+            index = block.rfind(needle)
+            if index >= 0:
+                return start + index
+            position = start
+        return -1
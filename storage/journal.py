@@ -0,0 +1,318 @@
+"""Provides the message journal that a chat export is built from.
+
+The journal of a chat is a newline-delimited JSON file next to its
+export.json. The first line holds the chat information and every other line
+holds one serialized message, so appending a batch only writes that batch,
+and an interrupted write only ever damages the last line. The export.json
+file is generated from the journal when it's needed, and a hidden file next
+to it records the size of the journal that it was generated from, so that
+only the messages appended since then have to be added to it.
+
+Run ``python -m storage.journal <chat directory>...`` to generate the
+export.json files of chats from their journals.
+"""
+
+import argparse
+import json
+import logging
+import os
+from collections.abc import Iterator
+from itertools import batched
+from pathlib import Path
+from typing import IO, Any
+
+from .export_json import ExportJsonWriter
+
+log = logging.getLogger(__name__)
+
+
+class MessageJournal:
+    """Append-only journal of the serialized messages of a chat.
+
+    The journal is only created once the first messages are appended. A line
+    that was left incomplete by an interrupted write is removed when the
+    journal is opened. Opening it only reads its last few lines, so the cost
+    doesn't depend on the size of the export.
+
+    Chats that were exported before the journal existed only have an
+    export.json file. Their messages are copied into a new journal once, the
+    first time it's opened.
+
+    Writing and generating the export.json file block, so async code should
+    run the journal in a thread, one call at a time.
+
+    Parameters
+    ----------
+    directory : Path
+        The export directory of the chat.
+
+    chat : dict[str, Any] | None
+        The chat information that is written when the journal is created.
+        May only be None if the journal already exists.
+
+    Attributes
+    ----------
+    path : Path
+        The journal file.
+
+    export_json : Path
+        The export.json file that is generated from the journal.
+
+    export_json_state : Path
+        The file that records the size of the journal that export.json was
+        last generated from.
+
+    last_message_id : int
+        The id of the last message in the journal, or 0 if there are none.
+
+    """
+
+    _BLOCK_SIZE = 64 * 1024
+
+    # How many messages are read at once when generating export.json
+    _MATERIALIZE_BATCH_SIZE = 1000
+
+    def __init__(self, directory: Path, chat: dict[str, Any] | None = None) -> None:
+        self.path = directory / "messages.jsonl"
+        self.export_json = directory / "export.json"
+        self.export_json_state = directory / ".export_json_state"
+        self.last_message_id = 0
+
+        self._chat = chat
+        self._size = 0
+
+        if not self.path.exists() and self.export_json.exists():
+            self._import_export_json()
+
+        if self.path.exists():
+            with self.path.open("r+b") as file:
+                self._recover(file)
+                file.seek(0)
+                if header := file.readline():
+                    self._chat = json.loads(header)
+                    self.last_message_id = self._find_last_message_id(file)
+                    self._size = file.seek(0, os.SEEK_END)
+            # The journal was interrupted while it was being created
+            if not header:
+                self.path.unlink()
+
+        if not self.path.exists() and chat is None:
+            msg = f"{self.path} doesn't exist"
+            raise FileNotFoundError(msg)
+
+    def append(self, messages: list[dict[str, Any]]) -> None:
+        """Append messages to the end of the journal.
+
+        The journal is flushed to disk before returning, so the messages are
+        never lost once this method completes.
+
+        Parameters
+        ----------
+        messages : list[dict[str, Any]]
+            The serialized messages.
+
+        """
+        if not messages:
+            return
+
+        lines = [self._encode(message) for message in messages]
+        if not self.path.exists():
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            lines.insert(0, self._encode(self._chat))
+
+        with self.path.open("ab") as file:
+            self._size = file.seek(0, os.SEEK_END) + file.write(b"".join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+
+        for message in reversed(messages):
+            if "id" in message:
+                self.last_message_id = message["id"]
+                break
+
+    def outdated(self) -> bool:
+        """Check whether export.json is behind the journal.
+
+        That's the case when messages were appended after it was last
+        generated, for example by a run that was interrupted before
+        generating it, or by one that didn't write export.json at all.
+
+        Returns
+        -------
+        bool
+            Whether export.json has to be generated again.
+
+        """
+        if not self.path.exists():
+            return False
+        return self._load_state() != self._size
+
+    def materialize(self) -> None:
+        """Generate the export.json file from the journal.
+
+        If export.json was generated from an earlier state of the journal,
+        only the messages that were appended since then are added to it.
+        Otherwise, it's generated from scratch next to export.json and only
+        replaces it once it's complete, so an interruption never leaves a
+        broken export.json behind. Nothing is generated if the journal
+        doesn't exist yet.
+        """
+        if not self.path.exists():
+            return
+
+        state = self._load_state()
+        if state == self._size:
+            return
+        if state is not None and state < self._size:
+            self._extend_export_json(state)
+            return
+
+        temporary = self.export_json.with_name(f"{self.export_json.name}.tmp")
+        temporary.unlink(missing_ok=True)
+
+        writer = ExportJsonWriter(temporary, self._chat or {})
+        self._write_messages(writer, self._messages())
+        # The writer only creates the file along with the first messages
+        if not temporary.exists():
+            temporary.write_bytes(
+                json.dumps(
+                    (self._chat or {}) | {"messages": []},
+                    indent=1,
+                    ensure_ascii=False,
+                ).encode(),
+            )
+        temporary.replace(self.export_json)
+        self._save_state(self._size)
+
+    def _extend_export_json(self, start: int) -> None:
+        # The state is removed while export.json is extended in place, so an
+        # interruption makes the next run generate it from scratch instead
+        # of appending the same messages twice.
+        self.export_json_state.unlink()
+
+        writer = ExportJsonWriter(self.export_json, self._chat or {})
+        self._write_messages(writer, self._messages(start))
+        self._save_state(self._size)
+
+    def _write_messages(
+        self,
+        writer: ExportJsonWriter,
+        messages: Iterator[dict[str, Any]],
+    ) -> None:
+        for batch in batched(messages, self._MATERIALIZE_BATCH_SIZE, strict=False):
+            writer.append(list(batch))
+
+    def _messages(self, start: int | None = None) -> Iterator[dict[str, Any]]:
+        # Reads the messages from an offset of the journal, or all of them
+        with self.path.open("rb") as file:
+            if start is None:
+                file.readline()
+            else:
+                file.seek(start)
+            for line in file:
+                yield json.loads(line)
+
+    def _load_state(self) -> int | None:
+        # Returns the size of the journal that export.json was generated
+        # from, or None if export.json has to be generated from scratch.
+        if not self.export_json.exists():
+            return None
+        try:
+            state = int(self.export_json_state.read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+        return state if state > 0 else None
+
+    def _import_export_json(self) -> None:
+        log.info("Copying the messages of %s into a journal", self.export_json)
+
+        with self.export_json.open("rb") as file:
+            export = json.load(file)
+        messages = export.pop("messages")
+
+        # The journal only gets its final name once it's complete, so an
+        # interrupted import is started over.
+        temporary = self.path.with_name(f"{self.path.name}.tmp")
+        with temporary.open("wb") as file:
+            file.write(self._encode(export))
+            for message in messages:
+                file.write(self._encode(message))
+            size = file.tell()
+            file.flush()
+            os.fsync(file.fileno())
+        temporary.replace(self.path)
+
+        # The existing export.json holds exactly the imported messages
+        self._save_state(size)
+
+    def _save_state(self, size: int) -> None:
+        # Written after export.json, so an interruption in between only
+        # makes export.json look outdated, never up to date.
+        temporary = self.export_json_state.with_name(
+            f"{self.export_json_state.name}.tmp",
+        )
+        temporary.write_text(str(size), encoding="utf-8")
+        temporary.replace(self.export_json_state)
+
+    def _recover(self, file: IO[bytes]) -> None:
+        size = file.seek(0, os.SEEK_END)
+        end = self._rfind(file, b"\n", size) + 1
+        if end == size:
+            return
+
+        log.warning("%s is incomplete, removing its last line", self.path)
+        file.truncate(end)
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _find_last_message_id(self, file: IO[bytes]) -> int:
+        # Messages that failed to serialize are written as empty objects, so
+        # walk back until a message that has an id.
+        header_end = file.tell()
+        end = file.seek(0, os.SEEK_END) - 1
+        while end > header_end:
+            start = self._rfind(file, b"\n", end) + 1
+            file.seek(start)
+            message = json.loads(file.read(end - start))
+            if "id" in message:
+                return int(message["id"])
+            end = start - 1
+        return 0
+
+    def _rfind(self, file: IO[bytes], needle: bytes, end: int) -> int:
+        # Returns the offset of the last occurrence of the needle before end,
+        # reading the file backwards in blocks, or -1 if there is none.
+        position = end
+        while position > 0:
+            start = max(0, position - self._BLOCK_SIZE)
+            file.seek(start)
+            index = file.read(position - start).rfind(needle)
+            if index >= 0:
+                return start + index
+            position = start
+        return -1
+
+    @staticmethod
+    def _encode(value: object) -> bytes:
+        # JSON escapes line breaks in strings, so every value is one line
+        line = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        return f"{line}\n".encode()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m storage.journal",
+        description="Generate the export.json files of chats from their journals.",
+    )
+    parser.add_argument(
+        "directories",
+        nargs="+",
+        type=Path,
+        help="the export directories of the chats",
+    )
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for directory in arguments.directories:
+        MessageJournal(directory).materialize()
+        log.info("Generated %s", directory / "export.json")
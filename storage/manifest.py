@@ -0,0 +1,129 @@
+"""Provides the "ExportManifest" class that tracks the files of an export."""
+
+import os
+from pathlib import Path
+
+
+class ExportManifest:
+    """The files and directories of a chat export, kept in memory.
+
+    The export directory is scanned once, when the manifest is first used,
+    and every file that the export writes afterwards is added to it. This
+    way, checking whether a file was already downloaded or creating its
+    directory doesn't touch the disk for every message.
+
+    Files that are deleted from the export directory while it's exported
+    aren't noticed, and are only downloaded again on the next run.
+
+    Parameters
+    ----------
+    path : Path
+        The directory that the export is saved to.
+
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._directories: dict[Path, set[str]] | None = None
+        self._next_numbers: dict[Path, int] = {}
+
+    def scan(self) -> None:
+        """Scan the export directory, unless it was already scanned.
+
+        This blocks, so async code should call it in a thread before using
+        the manifest.
+        """
+        if self._directories is not None:
+            return
+
+        directories: dict[Path, set[str]] = {}
+        pending = [self.path]
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+
+            directories[directory] = set()
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(directory / entry.name)
+                else:
+                    directories[directory].add(entry.name)
+
+        self._directories = directories
+
+    def exists(self, file: Path) -> bool:
+        """Check whether a file is in the export.
+
+        Parameters
+        ----------
+        file : Path
+            The file, inside of the export directory.
+
+        Returns
+        -------
+        bool
+            Whether the file exists.
+
+        """
+        return file.name in self._scanned().get(file.parent, ())
+
+    def add(self, file: Path) -> None:
+        """Record a file that was written to the export.
+
+        Parameters
+        ----------
+        file : Path
+            The file, inside of the export directory.
+
+        """
+        self._scanned().setdefault(file.parent, set()).add(file.name)
+
+    def mkdir(self, directory: Path) -> None:
+        """Create a directory in the export, unless it already exists.
+
+        Parameters
+        ----------
+        directory : Path
+            The directory, inside of the export directory.
+
+        """
+        directories = self._scanned()
+        if directory not in directories:
+            directory.mkdir(parents=True, exist_ok=True)
+            directories[directory] = set()
+
+    def next_number(self, directory: Path) -> int:
+        """Reserve the next number for a file named like "contact_1.vcard".
+
+        Parameters
+        ----------
+        directory : Path
+            The directory of the numbered files.
+
+        Returns
+        -------
+        int
+            A number that is higher than the one of every file in the
+            directory and every number reserved before.
+
+        """
+        if directory not in self._next_numbers:
+            n = 1
+            for name in self._scanned().get(directory, ()):
+                try:
+                    n = max(n, int(Path(name).stem.split("_")[1]) + 1)
+                except (IndexError, ValueError):
+                    continue
+            self._next_numbers[directory] = n
+
+        n = self._next_numbers[directory]
+        self._next_numbers[directory] = n + 1
+        return n
+
+    def _scanned(self) -> dict[Path, set[str]]:
+        self.scan()
+        assert self._directories is not None  # noqa: S101
+        return self._directories
@@ -0,0 +1,85 @@
+"""Provides a media store that is shared by the exports of all chats."""
+
+import asyncio
+import logging
+import os
+import shutil
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class MediaStore:
+    """A directory that keeps a single copy of every downloaded file.
+
+    Files in chat exports are named after the id of their Telegram document or
+    photo, so the same file always has the same name, no matter which chat
+    it's exported from. The store downloads each file once and hardlinks it
+    into every chat that has it, falling back to a copy when hardlinks aren't
+    supported.
+
+    Parameters
+    ----------
+    path : Path
+        The directory that the files are stored in.
+
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._locks: dict[Path, asyncio.Lock] = {}
+
+    async def fetch(
+        self,
+        file: Path,
+        download: Callable[[Path], Awaitable[bool]],
+    ) -> bool:
+        """Put a file into a chat export, downloading it only if needed.
+
+        Parameters
+        ----------
+        file : Path
+            The path of the file in the chat export. Its directory has to
+            exist already.
+
+        download : Callable[[Path], Awaitable[bool]]
+            Downloads the file to the given path, returning False if it's
+            unavailable.
+
+        Returns
+        -------
+        bool
+            Whether the file is available.
+
+        """
+        stored = self.path / file.parent.name / file.name
+
+        # Multiple chats may need the same file at once, but it should only be
+        # downloaded by one of them.
+        lock = self._locks.setdefault(stored, asyncio.Lock())
+        async with lock:
+            if not await asyncio.to_thread(stored.exists):
+                await asyncio.to_thread(
+                    stored.parent.mkdir,
+                    exist_ok=True,
+                    parents=True,
+                )
+                if not await download(stored):
+                    return False
+            else:
+                log.info("Reusing %s from the media store", stored.name)
+
+        # Copying a large file from another file system takes long, so it
+        # doesn't happen on the event loop.
+        await asyncio.to_thread(self._link, stored, file)
+        return True
+
+    @staticmethod
+    def _link(stored: Path, file: Path) -> None:
+        try:
+            os.link(stored, file)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(stored, file)